@@ -0,0 +1,36 @@
+"""Add a denormalized vote_count column in post model
+
+Revision ID: 3c8d1f0a7b21
+Revises: f49ed695aa5b
+Create Date: 2026-10-18 10:12:41.208315
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3c8d1f0a7b21'
+down_revision: Union[str, Sequence[str], None] = 'f49ed695aa5b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('posts', sa.Column('vote_count', sa.Integer(), server_default='0', nullable=False))
+    # backfill the counter from the existing votes
+    op.execute(
+        """
+        UPDATE posts SET vote_count = counts.votes
+        FROM (SELECT post_id, count(*) AS votes FROM votes GROUP BY post_id) AS counts
+        WHERE posts.id = counts.post_id
+        """
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('posts', 'vote_count')
@@ -0,0 +1,39 @@
+"""Add an indexed hot_score column in post model for the ranked feed
+
+Revision ID: b5f7e3a1c940
+Revises: 8a4e2c9d5f13
+Create Date: 2026-10-18 14:26:09.117352
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b5f7e3a1c940'
+down_revision: Union[str, Sequence[str], None] = '8a4e2c9d5f13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('posts', sa.Column('hot_score', sa.Float(), server_default='0', nullable=False))
+    # initial scores with the default gravity (1.8) and window (72 hours),
+    # the app's background job keeps them up to date from here on
+    op.execute(
+        """
+        UPDATE posts
+        SET hot_score = vote_count / power(extract(epoch FROM now() - created_at) / 3600 + 2, 1.8)
+        WHERE created_at > now() - interval '72 hours'
+        """
+    )
+    op.create_index('ix_posts_hot_score_id', 'posts', ['hot_score', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_posts_hot_score_id', table_name='posts')
+    op.drop_column('posts', 'hot_score')
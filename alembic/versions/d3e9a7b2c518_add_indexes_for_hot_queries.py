@@ -0,0 +1,47 @@
+"""Add indexes for the hot post and vote queries
+
+Revision ID: d3e9a7b2c518
+Revises: b5f7e3a1c940
+Create Date: 2026-10-18 16:02:41.530274
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3e9a7b2c518'
+down_revision: Union[str, Sequence[str], None] = 'b5f7e3a1c940'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (name, table, columns)
+INDEXES = [
+    # a user's posts (export scope=mine) in id order, and the posts.user_id foreign key
+    ('ix_posts_user_id_id', 'posts', ['user_id', 'id']),
+    # newest first / cursor pages of GET /posts/
+    ('ix_posts_created_at_id', 'posts', ['created_at', 'id']),
+    # votes of a post: the primary key (user_id, post_id) can't be used for it,
+    # needed by the ON DELETE CASCADE from posts and the vote_count backfills
+    ('ix_votes_post_id', 'votes', ['post_id']),
+]
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY doesn't block writes while the index is built, but it can't
+    # run inside a transaction. if_not_exists makes a rerun after a failed
+    # build pass (drop an INVALID leftover index by hand first)
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
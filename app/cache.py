@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from .config import settings
+from .invalidation import bus
+
+
+class TTLCache:
+    # small in-process LRU cache where every entry also expires after `ttl` seconds
+    # thread safe, so it can be used from the threadpool (sync database mode)
+    # maxsize 0 disables the cache: get always misses and set is a no-op
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # key -> how many times it was invalidated, the oldest are forgotten past
+        # max_generations (bumping the epoch, so no reader misses an invalidation)
+        self._generations = OrderedDict()
+        self._max_generations = max(maxsize, 1) * 2
+        self._epoch = 0
+
+    def get(self, key, default=None):
+        if not self.maxsize:
+            return default
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def generation(self, key):
+        # take it before reading the value from the database and pass it to set(),
+        # the set is skipped when the key got invalidated in between
+        with self._lock:
+            return (self._epoch, self._generations.get(key, 0))
+
+    def set(self, key, value, generation=None):
+        if not self.maxsize:
+            return
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(key, 0)):
+                # a writer invalidated the key while we were reading, the value may be stale
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generations[key] = self._generations.pop(key, 0) + 1
+            if len(self._generations) > self._max_generations:
+                self._generations.popitem(last=False)
+                self._epoch += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generations.clear()
+            self._epoch += 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+def make_etag(body: bytes):
+    # strong validator, same bytes -> same etag on every worker
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses the weak comparison, so W/"x" matches "x"
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+# serialized GET /posts/latest and GET /posts/{id} responses: key -> (body, etag)
+# keys are the post id, and "latest"
+post_response_cache = TTLCache(settings.post_cache_size, settings.post_cache_ttl_seconds)
+
+
+def invalidate_post(post_id: int = None):
+    # any write to a post (or its votes) can change both its own response and /latest
+    if post_id is not None:
+        post_response_cache.invalidate(post_id)
+    post_response_cache.invalidate("latest")
+
+# writers publish "post" events, see invalidation.py
+bus.register("post", invalidate_post, post_response_cache.clear)
@@ -1,20 +1,256 @@
 
-from sqlalchemy import create_engine
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager
+from sqlalchemy import create_engine, exc
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from starlette.concurrency import run_in_threadpool
+from . import metrics
 from .config import settings
 # SQLALCHEMY_DATABASE_URL = "postgresql://<username>:<password>@<id-address/localhost>/<database_name>"
 SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
+# same database through the asyncpg driver
+SQLALCHEMY_ASYNC_DATABASE_URL = f"postgresql+asyncpg://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+class PoolStats:
+    # how long requests wait to get a connection out of the pool
+    def __init__(self, name):
+        self.name = name
+        self.pool = None
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def record_checkout(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def snapshot(self):
+        pool = self.pool
+        return {
+            "name": self.name,
+            "pool": type(pool).__name__,
+            "status": pool.status(),
+            # NullPool keeps no connections so it has no size / in use numbers
+            "size": pool.size() if hasattr(pool, "size") else None,
+            "in_use": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "idle": pool.checkedin() if hasattr(pool, "checkedin") else None,
+            "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+            "checkouts": self.checkouts,
+            "checkout_timeouts": self.timeouts,
+            "checkout_wait_avg_ms": round(self.checkout_wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "checkout_wait_max_ms": round(self.checkout_wait_max * 1000, 3),
+        }
+
+# engine name -> PoolStats, read by the admin router
+pool_stats = {}
+
+
+class _CheckoutTimingMixin:
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            if self.stats is not None:
+                self.stats.record_checkout(time.perf_counter() - start, timed_out)
+
+    def recreate(self):
+        # engine.dispose() swaps the pool, keep counting into the same stats
+        new_pool = super().recreate()
+        new_pool.stats = self.stats
+        if self.stats is not None:
+            self.stats.pool = new_pool
+        return new_pool
+
+
+class InstrumentedQueuePool(_CheckoutTimingMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(_CheckoutTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+class InstrumentedNullPool(_CheckoutTimingMixin, NullPool):
+    pass
+
+
+def engine_options(is_async: bool):
+    if settings.db_pgbouncer_mode:
+        # PgBouncer (transaction pooling) does the pooling, so open a connection per
+        # checkout and don't keep server side prepared statements around
+        # (the psycopg2 driver never prepares, asyncpg needs its caches turned off)
+        options = {"poolclass": InstrumentedNullPool, "pool_pre_ping": settings.db_pool_pre_ping, "query_cache_size": settings.db_query_cache_size}
+        if is_async:
+            options["connect_args"] = {"statement_cache_size": 0, "prepared_statement_cache_size": 0}
+        return options
+
+    return {
+        "poolclass": InstrumentedAsyncAdaptedQueuePool if is_async else InstrumentedQueuePool,
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "query_cache_size": settings.db_query_cache_size,
+    }
+
+
+def track_pool(name, sync_engine):
+    stats = PoolStats(name)
+    stats.pool = sync_engine.pool
+    sync_engine.pool.stats = stats
+    pool_stats[name] = stats
+
+
+def pool_status():
+    return [stats.snapshot() for stats in pool_stats.values()]
+
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(is_async=False))
+
+# expire_on_commit is off so committed objects can still be serialized
+# in the response without another (lazy) round trip to the database
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+# async path (the default): requests wait on postgres without holding a threadpool thread
+# set DATABASE_ASYNC=false to go back to the sync psycopg2 engine
+async_engine = create_async_engine(SQLALCHEMY_ASYNC_DATABASE_URL, **engine_options(is_async=True)) if settings.database_async else None
+
+AsyncSessionLocal = sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine, class_=AsyncSession)
+
+track_pool("primary", async_engine.sync_engine if settings.database_async else engine)
+# statement count / DB time per request, see metrics.py
+metrics.instrument_engine("primary", async_engine.sync_engine if settings.database_async else engine)
+
+
+# read replicas (settings.database_replica_urls), used round robin by db_session(read_only=True)
+# which routes use them is decided in db_routing.py
+replica_sessionmakers = []
+for index, replica_url in enumerate(settings.database_replica_urls):
+    if settings.database_async:
+        replica_engine = create_async_engine(replica_url.replace("postgresql://", "postgresql+asyncpg://", 1), **engine_options(is_async=True))
+        replica_sync_engine = replica_engine.sync_engine
+        replica_sessionmakers.append(sessionmaker(autoflush=False, expire_on_commit=False, bind=replica_engine, class_=AsyncSession))
+    else:
+        replica_engine = replica_sync_engine = create_engine(replica_url, **engine_options(is_async=False))
+        replica_sessionmakers.append(sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=replica_engine))
+    track_pool(f"replica-{index}", replica_sync_engine)
+    metrics.instrument_engine(f"replica-{index}", replica_sync_engine)
+
+_next_replica = itertools.cycle(replica_sessionmakers)
+
+
+def pick_sessionmaker(read_only: bool = False):
+    if read_only and replica_sessionmakers:
+        return next(_next_replica)
+    return AsyncSessionLocal if settings.database_async else SessionLocal
+
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+class SyncSessionAdapter:
+    # gives a sync Session the awaitable api of AsyncSession so the routers
+    # work with both engines, every call that can do I/O runs in the threadpool
+    def __init__(self, sync_session):
+        self.sync_session = sync_session
+
+    @property
+    def info(self):
+        return self.sync_session.info
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def execute(self, statement, params=None, **kw):
+        return await run_in_threadpool(self.sync_session.execute, statement, params, **kw)
+
+    async def scalar(self, statement, params=None, **kw):
+        return await run_in_threadpool(self.sync_session.scalar, statement, params, **kw)
+
+    async def get(self, entity, ident, **kw):
+        return await run_in_threadpool(self.sync_session.get, entity, ident, **kw)
+
+    async def refresh(self, instance, attribute_names=None):
+        await run_in_threadpool(self.sync_session.refresh, instance, attribute_names)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+
+@asynccontextmanager
+async def db_session(read_only: bool = False):
+    # a session outside of a request (background jobs, startup, ...)
+    # read_only sessions go to a replica when there is one
+    session_factory = pick_sessionmaker(read_only)
+    if settings.database_async:
+        async with session_factory() as db:
+            yield db
+    else:
+        db = SyncSessionAdapter(session_factory())
+        try:
+            yield db
+        finally:
+            await db.close()
+
+
+async def get_db():
+    async with db_session() as db:
         yield db
-    finally:
-        db.close()
+
+
+async def stream_mappings(statement, batch_size: int = 1000, read_only: bool = False):
+    # runs `statement` on a server side cursor with its own session and yields
+    # lists of at most batch_size row mappings, memory stays flat whatever the
+    # number of rows (for StreamingResponse bodies, which outlive the request's get_db session)
+    session_factory = pick_sessionmaker(read_only)
+    if settings.database_async:
+        async with session_factory() as db:
+            result = await db.stream(statement.execution_options(yield_per=batch_size))
+            async for partition in result.mappings().partitions(batch_size):
+                yield partition
+    else:
+        db = session_factory()
+        try:
+            result = await run_in_threadpool(db.execute, statement.execution_options(stream_results=True, yield_per=batch_size))
+            mappings = result.mappings()
+            while True:
+                partition = await run_in_threadpool(mappings.fetchmany, batch_size)
+                if not partition:
+                    break
+                yield partition
+        finally:
+            await run_in_threadpool(db.close)
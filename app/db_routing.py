@@ -0,0 +1,40 @@
+# Read replica routing with read-your-writes
+# Read only routes take their session from get_read_db (a replica, round robin),
+# write routes from get_write_db (the primary). After a write the user is pinned
+# to the primary for settings.read_your_writes_seconds, so their next reads see
+# their own post / vote even if the replicas lag behind.
+# Pins are shared by all worker processes through the invalidation bus.
+from typing import Optional
+from fastapi import Depends
+
+from . import database, invalidation, oauth2
+from .cache import TTLCache
+from .config import settings
+
+# user id -> True while that user's reads have to go to the primary
+primary_pins = TTLCache(100_000, settings.read_your_writes_seconds)
+
+
+def pin_to_primary(user_id: int):
+    primary_pins.set(user_id, True)
+
+
+# published by get_write_db when the write commits, every process pins the user
+invalidation.bus.register("pin", pin_to_primary)
+
+
+def is_pinned(user_id: Optional[int]):
+    return user_id is not None and primary_pins.get(user_id, False)
+
+
+async def get_read_db(user_id: Optional[int] = Depends(oauth2.get_token_user_id)):
+    async with database.db_session(read_only=not is_pinned(user_id)) as db:
+        yield db
+
+
+async def get_write_db(user_id: Optional[int] = Depends(oauth2.get_token_user_id)):
+    async with database.db_session() as db:
+        if user_id is not None:
+            # sent only if the route commits
+            invalidation.publish(db, "pin", user_id)
+        yield db
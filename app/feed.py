@@ -0,0 +1,59 @@
+# "Hot" ranking of posts for GET /posts/feed
+# hot_score = votes / (age in hours + 2) ^ gravity  (hacker news style)
+# It's stored in posts.hot_score (indexed) so serving the feed is an index scan:
+#   - the vote router recomputes it for the post it just changed
+#   - refresh_hot_scores() re-decays every post younger than the window on an
+#     interval, posts that get older than the window drop to 0
+import asyncio
+import logging
+from datetime import timedelta
+
+from sqlalchemy import Float, case, cast, extract, func, or_, select, update
+
+from . import database, models
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# pg advisory lock id, only one worker re-decays at a time
+HOT_SCORE_LOCK_ID = 7_204_815
+
+
+def hot_score_expression(vote_count, created_at):
+    age_hours = extract("epoch", func.now() - created_at) / 3600
+    return cast(vote_count, Float) / func.power(cast(age_hours + 2, Float), settings.hot_score_gravity)
+
+
+def hot_score_refresh_statement():
+    posts = models.Post.__table__
+    in_window = posts.c.created_at > func.now() - timedelta(hours=settings.hot_score_window_hours)
+    return (
+        update(posts)
+        # scores are never negative, "> 0" is a range on ix_posts_hot_score_id ("!= 0"
+        # can't use it and made this a full scan / rewrite of posts), in_window one
+        # on ix_posts_created_at_id
+        .where(or_(in_window, posts.c.hot_score > 0))
+        .values(hot_score=case((in_window, hot_score_expression(posts.c.vote_count, posts.c.created_at)), else_=0.0))
+    )
+
+
+async def refresh_hot_scores():
+    async with database.db_session() as db:
+        # transaction level lock, released by the commit
+        locked = await db.scalar(select(func.pg_try_advisory_xact_lock(HOT_SCORE_LOCK_ID)))
+        if not locked:
+            return 0
+        result = await db.execute(hot_score_refresh_statement())
+        await db.commit()
+        return result.rowcount
+
+
+async def run_hot_score_refresher():
+    # background task started by the app lifespan
+    while True:
+        try:
+            updated = await refresh_hot_scores()
+            logger.debug("re-decayed hot_score of %s posts", updated)
+        except Exception:
+            logger.exception("hot_score refresh failed")
+        await asyncio.sleep(settings.hot_score_refresh_seconds)
@@ -0,0 +1,193 @@
+# Cache invalidation bus
+# Every worker process (on every host) has its own in-process caches, so a write
+# handled by one worker has to drop the cached entries everywhere. Writers call
+#     invalidation.publish(db, "post", post_id)
+# before committing. On commit the events go out with pg_notify in the same
+# transaction (nothing is sent when it rolls back), and this process drops its
+# own entries right after the commit. Every process LISTENs on the channel with
+# a dedicated connection in a background thread and drops the keys from the
+# caches registered under that name, usually within a few milliseconds.
+#
+# No extra infrastructure, but:
+#   - the LISTEN connection has to go straight to postgres (PgBouncer in
+#     transaction mode takes the LISTEN but never delivers anything), behind
+#     PgBouncer set settings.cache_invalidation_listen_url, see listen_url()
+#   - events sent while a process isn't listening (reconnect) are lost, so it
+#     clears its caches when the connection is (re)established
+#   - the caches keep their TTLs as a backstop
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import uuid
+
+from sqlalchemy import event, func
+from sqlalchemy import select as sql_select
+from sqlalchemy.orm import Session
+
+from . import metrics
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# our own events come back through LISTEN too, they're already applied locally
+ORIGIN = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# pg_notify payloads must stay under 8000 bytes
+MAX_PAYLOAD = 7000
+
+
+class CacheHandler:
+    def __init__(self, invalidate, clear=None):
+        self.invalidate = invalidate
+        self.clear = clear
+
+
+class InvalidationBus:
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.handlers = {}
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def register(self, name, invalidate, clear=None):
+        # invalidate(key) drops one entry, clear() everything (after missed events)
+        self.handlers[name] = CacheHandler(invalidate, clear)
+
+    def publish(self, db, name, key=None):
+        # db is a Session, an AsyncSession or a SyncSessionAdapter, the events
+        # are sent / applied when it commits
+        session = getattr(db, "sync_session", db)
+        session.info.setdefault("invalidations", []).append((name, key))
+
+    def apply(self, events, source):
+        for name, key in events:
+            handler = self.handlers.get(name)
+            if handler is None:
+                continue
+            handler.invalidate(key)
+            metrics.CACHE_INVALIDATIONS.labels(name, source).inc()
+
+    def payloads(self, events):
+        # as few NOTIFYs as the payload size limit allows
+        chunk = []
+        for item in events:
+            chunk.append(item)
+            if len(chunk) > 1 and len(json.dumps(chunk)) > MAX_PAYLOAD:
+                chunk.pop()
+                yield json.dumps({"origin": ORIGIN, "events": chunk})
+                chunk = [item]
+        if chunk:
+            yield json.dumps({"origin": ORIGIN, "events": chunk})
+
+    def receive(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning("ignoring malformed invalidation payload %r", payload)
+            return
+        if message.get("origin") != ORIGIN:
+            self.apply([tuple(item) for item in message.get("events", [])], "remote")
+
+    def clear_all(self):
+        for handler in self.handlers.values():
+            if handler.clear is not None:
+                handler.clear()
+
+    def start(self, dsn):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._listen, args=(dsn,), name="cache-invalidation-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _listen(self, dsn):
+        import psycopg2
+
+        delay = 1
+        while not self._stopping.is_set():
+            try:
+                connection = psycopg2.connect(dsn)
+            except Exception:
+                logger.exception("cache invalidation listener can't connect, retrying in %s seconds", delay)
+                self._stopping.wait(delay)
+                delay = min(delay * 2, 30)
+                continue
+            try:
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN "{self.channel}"')
+                delay = 1
+                # whatever was published while we weren't listening is lost
+                self.clear_all()
+                while not self._stopping.is_set():
+                    if select.select([connection], [], [], 1.0)[0]:
+                        connection.poll()
+                        while connection.notifies:
+                            self.receive(connection.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("cache invalidation listener lost its connection")
+            finally:
+                connection.close()
+
+
+bus = InvalidationBus(settings.cache_invalidation_channel)
+
+
+def listen_url(database_url):
+    # where the listener connects, database_url is the primary's (the NOTIFYs
+    # themselves go out through the pool, PgBouncer passes them on fine)
+    if settings.cache_invalidation_listen_url:
+        return settings.cache_invalidation_listen_url
+    if settings.db_pgbouncer_mode:
+        logger.warning(
+            "db_pgbouncer_mode without cache_invalidation_listen_url: LISTEN goes through PgBouncer "
+            "and receives nothing, other workers' cache invalidations and live vote counts won't arrive"
+        )
+    return database_url
+
+
+def publish(db, name, key=None):
+    bus.publish(db, name, key)
+
+
+# Session events, for every session (async ones run a sync Session underneath)
+
+def _send_pending(session):
+    # runs inside the transaction: before the commit, and after flushes (ORM
+    # events like User after_update publish while the commit flushes)
+    pending = session.info.pop("invalidations", None)
+    if not pending:
+        return
+    session.info.setdefault("invalidations_sent", []).extend(pending)
+    if settings.cache_invalidation_enabled:
+        for payload in bus.payloads(pending):
+            session.connection().execute(sql_select(func.pg_notify(bus.channel, payload)))
+
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session):
+    _send_pending(session)
+
+
+@event.listens_for(Session, "after_flush_postexec")
+def _after_flush_postexec(session, flush_context):
+    _send_pending(session)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    sent = session.info.pop("invalidations_sent", None)
+    if sent:
+        bus.apply(sent, "local")
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("invalidations", None)
+    session.info.pop("invalidations_sent", None)
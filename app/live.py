@@ -0,0 +1,122 @@
+# Live vote counts (GET /live/votes, Server-Sent Events)
+# Clients subscribe to a set of post ids and get the new vote count pushed
+# whenever a vote on one of them commits, instead of polling GET /posts/{id}.
+#
+# Vote writers publish a "vote_count" event on the invalidation bus
+# (invalidation.py), so votes committed by any worker process reach the
+# subscribers of every process. VoteCountHub fans them out in process.
+#
+# Backpressure: a subscriber never has a queue of events. It has one pending
+# slot per post id (latest count, deltas summed), so a slow client gets fewer,
+# coalesced updates and its memory stays bounded by the number of posts it
+# watches, however fast the votes come in.
+import asyncio
+import json
+
+from fastapi import HTTPException, status
+from sqlalchemy import select
+
+from . import database, models
+from .config import settings
+from .invalidation import bus
+
+
+class Subscriber:
+    def __init__(self, post_ids):
+        self.post_ids = frozenset(post_ids)
+        # post_id -> (votes, delta since the last send)
+        self.pending = {}
+        self.wakeup = asyncio.Event()
+
+    def push(self, post_id, votes, delta):
+        _, pending_delta = self.pending.get(post_id, (None, 0))
+        self.pending[post_id] = (votes, pending_delta + delta)
+        self.wakeup.set()
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        self.wakeup.clear()
+        return pending
+
+
+class VoteCountHub:
+    def __init__(self, max_subscribers: int):
+        self.max_subscribers = max_subscribers
+        # post_id -> subscribers watching it
+        self.subscribers = {}
+        self.count = 0
+        self.loop = None
+
+    def start(self, loop):
+        # bus events arrive on the listener thread (or the threadpool in sync
+        # database mode), they're handed to this loop
+        self.loop = loop
+
+    def check_capacity(self):
+        # before the response starts, subscribe() itself runs inside the stream
+        if self.count >= self.max_subscribers:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many live subscribers, try again later", headers={"Retry-After": "5"})
+
+    def subscribe(self, post_ids):
+        subscriber = Subscriber(post_ids)
+        for post_id in subscriber.post_ids:
+            self.subscribers.setdefault(post_id, set()).add(subscriber)
+        self.count += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        for post_id in subscriber.post_ids:
+            watching = self.subscribers.get(post_id)
+            if watching is not None:
+                watching.discard(subscriber)
+                if not watching:
+                    del self.subscribers[post_id]
+        self.count -= 1
+
+    def publish(self, post_id, votes, delta):
+        # on the event loop
+        for subscriber in self.subscribers.get(post_id, ()):
+            subscriber.push(post_id, votes, delta)
+
+    def on_vote_count(self, key):
+        # bus handler, key is [post_id, votes, delta], from any thread
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.publish, *key)
+
+
+hub = VoteCountHub(settings.live_max_subscribers)
+bus.register("vote_count", hub.on_vote_count)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def current_vote_counts(post_ids):
+    # on the primary: a lagging replica could miss a vote committed just before
+    # the subscription, and no later event would correct it
+    async with database.db_session() as db:
+        result = await db.execute(select(models.Post.id, models.Post.vote_count).where(models.Post.id.in_(sorted(post_ids))))
+        return dict(result.all())
+
+
+async def vote_count_events(post_ids):
+    # subscribed inside the generator so the finally below always unsubscribes
+    subscriber = hub.subscribe(post_ids)
+    try:
+        # current counts first (read after subscribing, so no vote falls in between),
+        # missing posts are just never sent
+        for post_id, votes in (await current_vote_counts(subscriber.post_ids)).items():
+            yield sse_event("votes", {"post_id": post_id, "votes": votes, "delta": 0})
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.wakeup.wait(), settings.live_keepalive_seconds)
+            except asyncio.TimeoutError:
+                # comment line, keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            for post_id, (votes, delta) in subscriber.take().items():
+                yield sse_event("votes", {"post_id": post_id, "votes": votes, "delta": delta})
+    finally:
+        # client went away (the response task gets cancelled) or shutdown
+        hub.unsubscribe(subscriber)
@@ -6,7 +6,9 @@
 
 # import time
 # from typing import List, Optional
-from fastapi import FastAPI # , Response, status, HTTPException, Depends
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response # , status, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
 
 # from fastapi.params import Body
@@ -19,9 +21,45 @@ from fastapi.middleware.cors import CORSMiddleware
  # my created model, schemas etc 
 # from . import models
 # from .database import engine # get_db, SessionLocal
-from .routers import post, user, auth, vote
+from . import database, feed, invalidation, live, metrics, utils, warmup
+from .config import settings
+from .routers import post, user, auth, vote, admin, health
+from .routers import live as live_router
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background_tasks = []
+    # vote count events reach the GET /live/votes streams through this loop
+    live.hub.start(asyncio.get_running_loop())
+    if settings.cache_invalidation_enabled:
+        # LISTEN for cache invalidations of the other worker processes
+        invalidation.bus.start(invalidation.listen_url(database.SQLALCHEMY_DATABASE_URL))
+    # open pool connections / compile the hot statements, /readyz says ready after it
+    background_tasks.append(asyncio.create_task(warmup.warm_up()))
+    if settings.hot_score_refresh_seconds:
+        # keeps the /posts/feed ranking decaying with age
+        background_tasks.append(asyncio.create_task(feed.run_hot_score_refresher()))
+    if settings.vote_buffer_enabled:
+        vote.vote_buffer.start()
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    try:
+        if settings.vote_buffer_enabled:
+            # write out the votes still in memory
+            await vote.vote_buffer.stop()
+    finally:
+        if settings.cache_invalidation_enabled:
+            await asyncio.to_thread(invalidation.bus.stop)
+        # stop the bcrypt worker processes
+        utils.password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     # "*" this * will allow all the domain incoming request
@@ -38,6 +76,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# request latency / SQL statements per request, exposed on /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
 # for use "SQLAlchemy" and "postgres"/"mysql"/"any other", Must install DB driver like "psycopg2" here we use
 # pip install SQLAlchemy==1.4
 
@@ -49,9 +90,18 @@ app.include_router(post.router)
 app.include_router(user.router)
 app.include_router(auth.router)
 app.include_router(vote.router)
+app.include_router(admin.router)
+app.include_router(health.router)
+app.include_router(live_router.router)
 
 @app.get("/")
 async def root():
     return {"message": "Hello Fast API !!"}
 
 
+# Prometheus scrape endpoint
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
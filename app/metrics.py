@@ -0,0 +1,160 @@
+# Prometheus metrics: per route latency, in-flight requests, and how many SQL
+# statements / how much DB time every request needs (served on /metrics)
+import time
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+
+from .config import settings
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being handled", ["method"])
+REQUEST_DB_STATEMENTS = Histogram(
+    "http_request_db_statements", "SQL statements executed per HTTP request", ["method", "route"],
+    buckets=(0, 1, 2, 3, 4, 5, 8, 13, 21, 34, 55, 89, float("inf")),
+)
+REQUEST_DB_TIME = Histogram("http_request_db_duration_seconds", "Time spent in the database per HTTP request", ["method", "route"])
+DB_STATEMENTS = Counter("db_statements_total", "SQL statements executed, in or outside of a request", ["engine"])
+# SQLAlchemy compiled statement cache, "hit" means the SQL string was reused instead of compiled again
+DB_STATEMENT_CACHE = Counter("db_statement_cache_total", "SQLAlchemy compiled statement cache lookups", ["engine", "result"])
+
+# invalidation.py, source is "local" (this process committed) or "remote" (LISTEN)
+CACHE_INVALIDATIONS = Counter("cache_invalidation_events_total", "Cache invalidation events applied", ["cache", "source"])
+
+# write-behind vote buffer (vote_buffer.py)
+VOTE_BUFFER_DEPTH = Gauge("vote_buffer_depth", "Votes waiting in the write-behind buffer")
+VOTE_BUFFER_FLUSH_LATENCY = Histogram("vote_buffer_flush_duration_seconds", "Time to write one buffered batch of votes")
+VOTE_BUFFER_FLUSHES = Counter("vote_buffer_flushes_total", "Vote buffer flushes", ["result"])
+VOTE_BUFFER_FLUSHED_VOTES = Counter("vote_buffer_flushed_votes_total", "Votes written by the vote buffer")
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+class RequestDbStats:
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+
+# set by MetricsMiddleware for the duration of one request, the engine hooks add to it
+# (the asyncio greenlets and the threadpool both see the context of the request)
+request_db_stats: ContextVar = ContextVar("request_db_stats", default=None)
+
+
+def instrument_engine(name, sync_engine):
+    # for an AsyncEngine pass async_engine.sync_engine
+    dialect = sync_engine.dialect
+    cache_results = {
+        dialect.CACHE_HIT: "hit",
+        dialect.CACHE_MISS: "miss",
+        dialect.CACHING_DISABLED: "disabled",
+        # text() / driver level SQL, nothing to cache
+        dialect.NO_CACHE_KEY: "no_key",
+        dialect.NO_DIALECT_SUPPORT: "unsupported",
+    }
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = request_db_stats.get()
+        if settings.query_budget_per_request and stats is not None and stats.statements >= settings.query_budget_per_request:
+            raise QueryBudgetExceeded(f"request ran more than {settings.query_budget_per_request} SQL statements, next one was: {statement}")
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        DB_STATEMENTS.labels(name).inc()
+        if context is not None:
+            DB_STATEMENT_CACHE.labels(name, cache_results.get(context.cache_hit, "unknown")).inc()
+        stats = request_db_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        # after_cursor_execute doesn't run for a failed statement
+        start_times = exception_context.connection.info.get("query_start_time") if exception_context.connection else None
+        if start_times:
+            start_times.pop()
+
+
+class MetricsMiddleware:
+    # plain ASGI middleware (not BaseHTTPMiddleware) so streaming responses aren't buffered
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestDbStats()
+        token = request_db_stats.set(stats)
+        REQUESTS_IN_PROGRESS.labels(method).inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_PROGRESS.labels(method).dec()
+            request_db_stats.reset(token)
+            # route template (/posts/{id}) not the raw path, to keep the label set small
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUESTS.labels(method, route, str(status_code)).inc()
+            REQUEST_LATENCY.labels(method, route).observe(elapsed)
+            REQUEST_DB_STATEMENTS.labels(method, route).observe(stats.statements)
+            REQUEST_DB_TIME.labels(method, route).observe(stats.db_time)
+
+
+class PoolCollector:
+    # connection pool and bcrypt queue numbers, read when /metrics is scraped
+    def describe(self):
+        # without it REGISTRY.register() calls collect() right away, while
+        # app.database (which imports this module) is only half initialized
+        return []
+
+    def collect(self):
+        from . import database, utils
+
+        in_use = GaugeMetricFamily("db_pool_connections_in_use", "Connections checked out of the pool", labels=["engine"])
+        idle = GaugeMetricFamily("db_pool_connections_idle", "Connections idle in the pool", labels=["engine"])
+        checkouts = CounterMetricFamily("db_pool_checkouts", "Connection checkouts", labels=["engine"])
+        timeouts = CounterMetricFamily("db_pool_checkout_timeouts", "Connection checkouts that timed out", labels=["engine"])
+        wait = CounterMetricFamily("db_pool_checkout_wait_seconds", "Total time spent waiting for a connection", labels=["engine"])
+        for stats in database.pool_stats.values():
+            snapshot = stats.snapshot()
+            if snapshot["in_use"] is not None:
+                in_use.add_metric([stats.name], snapshot["in_use"])
+                idle.add_metric([stats.name], snapshot["idle"])
+            checkouts.add_metric([stats.name], stats.checkouts)
+            timeouts.add_metric([stats.name], stats.timeouts)
+            wait.add_metric([stats.name], stats.checkout_wait_total)
+        yield from (in_use, idle, checkouts, timeouts, wait)
+
+        hasher = utils.password_hasher.stats()
+        yield GaugeMetricFamily("password_hash_waiting", "Password hashes waiting for a worker", value=hasher["waiting"])
+        yield GaugeMetricFamily("password_hash_running", "Password hashes running", value=hasher["running"])
+        yield CounterMetricFamily("password_hash_rejected", "Password hashes rejected because the queue was full", value=hasher["rejected"])
+
+
+REGISTRY.register(PoolCollector())
+
+
+def render():
+    return generate_latest(REGISTRY)
@@ -1,9 +1,13 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, Computed, Index
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.sql.expression import text
 from sqlalchemy.sql.sqltypes import TIMESTAMP
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 from .database import Base
 
+# text search configuration used for the posts full text search column
+SEARCH_CONFIG = "english"
+
 class Post(Base):
     __tablename__ = "posts"
 
@@ -13,7 +17,28 @@ class Post(Base):
     published = Column(Boolean, server_default="TRUE", nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=text('now()'), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
-    user = relationship("User")
+    # denormalized count of rows in votes for this post, kept in sync by the vote router
+    # so the read endpoints don't need to join and group by votes
+    vote_count = Column(Integer, server_default="0", nullable=False)
+    # ranking of GET /posts/feed, maintained by the vote router and feed.refresh_hot_scores
+    hot_score = Column(Float, server_default="0", nullable=False)
+    # generated by postgres from title + content, searched through the GIN index below
+    # deferred: only used in WHERE / ORDER BY, post reads never select it (and raise if they try)
+    search_vector = deferred(Column(TSVECTOR, Computed(f"to_tsvector('{SEARCH_CONFIG}', coalesce(title, '') || ' ' || coalesce(content, ''))", persisted=True)), raiseload=True)
+    # never lazy loaded: a lazy load per post is an N+1 while serializing a list,
+    # and an AsyncSession can't do it at all, so queries that need the author
+    # load it with joinedload (see routers/post.py) and anything else raises
+    user = relationship("User", lazy="raise_on_sql")
+
+    __table_args__ = (
+        Index("ix_posts_search_vector", "search_vector", postgresql_using="gin"),
+        # scanned backwards for ORDER BY hot_score DESC, id DESC
+        Index("ix_posts_hot_score_id", "hot_score", "id"),
+        # ORDER BY created_at DESC, id DESC and the cursor pages of GET /posts/
+        Index("ix_posts_created_at_id", "created_at", "id"),
+        # a user's posts in id order (export), also covers the user_id foreign key
+        Index("ix_posts_user_id_id", "user_id", "id"),
+    )
 
 
 class User(Base):
@@ -31,4 +56,5 @@ class User(Base):
 class Vote(Base):
     __tablename__ = "votes"
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
-    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    # the primary key starts with user_id, votes of a post need their own index
+    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True, nullable=False, index=True)
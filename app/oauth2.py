@@ -3,16 +3,25 @@ from jwt.exceptions import InvalidTokenError
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta, timezone
+from typing import Optional
 from . import schemas, database, models
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from .cache import TTLCache
+from .invalidation import bus
 from .config import settings
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="login")
+# same scheme, but a missing token isn't an error
+optional_oauth2_schema = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 
 SECTER_KEY = settings.secret_key
 ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
 
+# user id -> schemas.UserOut, so authenticated requests don't need a DB round trip
+user_cache = TTLCache(settings.user_cache_size, settings.user_cache_ttl_seconds)
+
 def create_access_token(data: dict):
     to_encode  = data.copy()
     
@@ -39,15 +48,61 @@ def verify_access_token(token: str, credentials_exception):
 
     return token_data
     
-def get_current_user(token: str = Depends(oauth2_schema), db: Session = Depends(database.get_db)):
+def get_token_user_id(token: Optional[str] = Depends(optional_oauth2_schema)):
+    # user id of a valid bearer token, None for anonymous / invalid tokens
+    # (only decodes the JWT, no database access)
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, SECTER_KEY, [ALGORITHM]).get("user_id")
+    except InvalidTokenError:
+        return None
+
+async def get_current_user(token: str = Depends(oauth2_schema)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    user = verify_access_token(token, credentials_exception)
+    token_data = verify_access_token(token, credentials_exception)
+
+    user = user_cache.get(token_data.id)
+    if user is None:
+        # own short session, closed (connection back in the pool) before the
+        # route runs: holding it for the whole request next to the route's
+        # session could deadlock the pool under load
+        async with database.db_session() as db:
+            user_info = await db.get(models.User, token_data.id)
+        if not user_info:
+            raise credentials_exception
+        # keep a plain copy, never a session bound ORM object
+        user = schemas.UserOut(id=user_info.id, email=user_info.email, is_active=user_info.is_active)
+        user_cache.set(user.id, user)
+
+    return user
+
+
+async def get_current_admin(current_user: schemas.UserOut = Depends(get_current_user)):
+    if current_user.email not in settings.admin_emails:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+
+def invalidate_user(user_id: int):
+    # call this after changing or deleting a user outside of the ORM (bulk update/delete statements)
+    user_cache.invalidate(user_id)
+
+
+bus.register("user", invalidate_user, user_cache.clear)
 
-    user = db.query(models.User).filter(models.User.id == user.id).first()
 
-    return user
\ No newline at end of file
+# ORM changes to a user drop it from the cache automatically, in every process
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        invalidate_user(target.id)
+    else:
+        bus.publish(session, "user", target.id)
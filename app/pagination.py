@@ -0,0 +1,55 @@
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+
+# Keyset (cursor) pagination helpers
+# A cursor is the sort key of the last row of the previous page, packed into an
+# opaque url-safe token, so the next page is a "seek" (WHERE key < cursor)
+# instead of an OFFSET that makes postgres read and throw away earlier rows
+
+
+def encode_cursor(*values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        if not isinstance(values, list):
+            raise ValueError(cursor)
+        return values
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def decode_post_cursor(cursor: str):
+    # post cursor -> (created_at, id)
+    values = decode_cursor(cursor)
+    try:
+        created_at, id = values
+        return datetime.fromisoformat(created_at), int(id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def decode_feed_cursor(cursor: str):
+    # feed cursor -> (hot_score, id)
+    values = decode_cursor(cursor)
+    try:
+        hot_score, id = values
+        return float(hot_score), int(id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def decode_user_cursor(cursor: str):
+    # user cursor -> id
+    values = decode_cursor(cursor)
+    try:
+        id, = values
+        return int(id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
@@ -0,0 +1,128 @@
+# Token bucket rate limiting
+# Every (limit name, identity) pair has a bucket of `capacity` tokens that refills
+# continuously at capacity / seconds tokens per second, a request takes one token
+# and gets a 429 with Retry-After when the bucket is empty. Limits are checked
+# before any hashing or database work of the route.
+#
+# Buckets live in a pluggable backend: InMemoryBackend for a single process, or
+# RedisBackend shared by every worker / host. Tests can swap in their own with
+# set_backend() (RedisBackend accepts any client with an async `eval`).
+import math
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request, status
+from .config import settings
+
+
+class RateLimit:
+    def __init__(self, spec: str):
+        # "20/60" -> bursts of 20, refilled over 60 seconds
+        capacity, seconds = spec.split("/")
+        self.capacity = float(capacity)
+        self.refill_rate = self.capacity / float(seconds)
+
+
+class InMemoryBackend:
+    # buckets of this process only, the least recently used ones are dropped past max_keys
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def take(self, key: str, capacity: float, refill_rate: float, cost: float = 1) -> float:
+        # returns 0 when allowed, otherwise the seconds until `cost` tokens are available
+        # (no await in here, so it's atomic on the event loop)
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill_rate)
+        retry_after = 0.0
+        if tokens >= cost:
+            tokens -= cost
+        else:
+            retry_after = (cost - tokens) / refill_rate
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+class RedisBackend:
+    # the same bucket math in a Lua script, so concurrent workers update a bucket atomically
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local refill_rate = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * refill_rate)
+    local retry_after = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        retry_after = (cost - tokens) / refill_rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_rate) + 1)
+    return tostring(retry_after)
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str):
+        # redis is only needed when this backend is configured
+        import redis.asyncio
+        return cls(redis.asyncio.from_url(url))
+
+    async def take(self, key: str, capacity: float, refill_rate: float, cost: float = 1) -> float:
+        retry_after = await self.client.eval(self.SCRIPT, 1, key, capacity, refill_rate, cost)
+        return float(retry_after)
+
+
+limits = {name: RateLimit(spec) for name, spec in settings.rate_limits.items()}
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = RedisBackend.from_url(settings.rate_limit_redis_url) if settings.rate_limit_backend == "redis" else InMemoryBackend()
+    return _backend
+
+
+def set_backend(backend):
+    global _backend
+    _backend = backend
+
+
+def client_ip(request: Request):
+    if settings.rate_limit_trust_forwarded_for:
+        forwarded_for = request.headers.get("x-forwarded-for")
+        if forwarded_for:
+            return forwarded_for.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+async def hit(name: str, identity):
+    # take a token from the `name` bucket of `identity` or raise 429
+    limit = limits.get(name)
+    if not settings.rate_limit_enabled or limit is None:
+        return
+    retry_after = await get_backend().take(f"ratelimit:{name}:{identity}", limit.capacity, limit.refill_rate)
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+
+def limit_by_ip(name: str):
+    # route dependency: dependencies=[Depends(ratelimit.limit_by_ip("login"))]
+    # route level dependencies run before the ones of the endpoint (db session, current user)
+    async def check_ip_limit(request: Request):
+        await hit(f"{name}:ip", client_ip(request))
+    return check_ip_limit
@@ -0,0 +1,19 @@
+from fastapi import Depends, APIRouter
+
+from .. import database, oauth2, utils
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"],
+    dependencies=[Depends(oauth2.get_current_admin)] # only for settings.admin_emails
+)
+
+@router.get("/db-pool")
+async def get_db_pool_stats():
+    # size / in use / idle connections and how long checkouts wait, per engine
+    return {"pools": database.pool_status()}
+
+@router.get("/password-hashing")
+async def get_password_hashing_stats():
+    # bcrypt process pool queue depth
+    return utils.password_hasher.stats()
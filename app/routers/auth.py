@@ -1,26 +1,38 @@
 from fastapi import APIRouter, Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from .. import database, schemas, models, utils, oauth2
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from .. import database, schemas, models, utils, oauth2, ratelimit
 
 
 router = APIRouter(tags=['Authantication'])
 
-@router.post("/login", response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
+@router.post("/login", response_model=schemas.Token, dependencies=[Depends(ratelimit.limit_by_ip("login"))])
+async def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_db)):
     # OAuth2PasswordRequestForm will work on username field not the email field
     # Also note that now request with raw-> json will not work, need to pass from-data 
     # {
     #     "username": "test3@faisalalam.me",
     #     "password": "123456"
     # }
-    user = db.query(models.User).filter(models.User.email == user_credentials.username).first()
+    # per account limit against credential stuffing, before the user lookup and bcrypt
+    await ratelimit.hit("login:account", user_credentials.username.lower())
+
+    result = await db.execute(select(models.User).where(models.User.email == user_credentials.username))
+    user = result.scalars().first()
 
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Invalid Credential")
 
-    if not utils.verify(user_credentials.password, user.password):
+    # bcrypt runs in the hashing process pool, off the request workers
+    verified, new_hash = await utils.password_hasher.verify_and_update(user_credentials.password, user.password)
+    if not verified:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Invalid Credential")
+
+    if new_hash:
+        # the configured bcrypt cost changed since this password was hashed
+        user.password = new_hash
+        await db.commit()
     
     # create a token
     access_token = oauth2.create_access_token(data = {"user_id": user.id, "email": user.email})
@@ -0,0 +1,22 @@
+from fastapi import APIRouter, Response, status
+
+from .. import warmup
+
+router = APIRouter(
+    tags=["Health"]
+)
+
+# liveness: the process is up and its event loop answers, no database involved
+# (a database outage shouldn't get every worker restarted)
+@router.get("/healthz", include_in_schema=False)
+async def healthz():
+    return {"status": "ok"}
+
+# readiness: warmed up (pool connections open, hot statements compiled) and
+# the database answers, 503 until then so the load balancer holds traffic back
+@router.get("/readyz", include_in_schema=False)
+async def readyz(response: Response):
+    if warmup.readiness.warmed_up and await warmup.database_reachable():
+        return {"status": "ready"}
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"status": "warming_up" if not warmup.readiness.warmed_up else "database_unavailable", "error": warmup.readiness.error}
@@ -0,0 +1,30 @@
+from typing import List
+from fastapi import Query, status, HTTPException, Depends, APIRouter
+from fastapi.responses import StreamingResponse
+
+from .. import live, oauth2, schemas
+from ..config import settings
+
+router = APIRouter(
+    prefix="/live", # router prefix
+    tags=["Live"] # this will seperate as group in API documentation
+)
+
+# Server-Sent Events instead of polling GET /posts/{id} for the vote counts:
+#   GET /live/votes?post_id=1&post_id=2
+#   event: votes
+#   data: {"post_id": 1, "votes": 42, "delta": 1}
+# the current counts come first, then one event per change (coalesced for slow
+# clients, see live.py). Authentication is checked once, when the stream opens
+@router.get("/votes", response_class=StreamingResponse, responses={200: {"content": {"text/event-stream": {}}}})
+async def live_votes(post_id: List[int] = Query(...), current_user: schemas.UserOut = Depends(oauth2.get_current_user)):
+    post_ids = set(post_id)
+    if len(post_ids) > settings.live_max_posts_per_subscription:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {settings.live_max_posts_per_subscription} posts per subscription")
+    live.hub.check_capacity()
+    return StreamingResponse(
+        live.vote_count_events(post_ids),
+        media_type="text/event-stream",
+        # no caching / proxy buffering, events have to go out as they happen
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
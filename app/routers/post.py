@@ -1,99 +1,307 @@
-from typing import List # Optional
-from fastapi import Response, status, HTTPException, Depends, APIRouter
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from .. import oauth2
+from functools import lru_cache
+from typing import List, Literal, Optional
+from fastapi import Query, Request, Response, status, HTTPException, Depends, APIRouter
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Boolean, Float, Integer, String, bindparam, delete, func, literal_column, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from .. import invalidation, oauth2, pagination, serialization
+from ..cache import post_response_cache, make_etag, etag_matches
 
- # my created model, schemas etc 
+ # my created model, schemas etc
 from .. import models, schemas
-from ..database import get_db
+from ..config import settings
+from ..database import get_db, stream_mappings
+from ..db_routing import get_read_db, get_write_db, is_pinned
 
 router = APIRouter(
     prefix="/posts", # router prefix
     tags=["Post"] # this will seperate as group in API documentation
 )
 
+
+def load_author():
+    # author is loaded in the same statement, an AsyncSession can't lazy load
+    # Post.user later while the response is serialized. Only the UserOut
+    # columns, never the password hash
+    return joinedload(models.Post.user).load_only(models.User.id, models.User.email, models.User.is_active)
+
+
+def select_posts_with_votes():
+    return select(models.Post, models.Post.vote_count.label("votes")).options(load_author())
+
+
+def select_post_rows():
+    # same data as select_posts_with_votes() as plain columns, for the fast JSON path
+    return select(
+        models.Post.id, models.Post.title, models.Post.content, models.Post.published, models.Post.created_at, models.Post.user_id,
+        # user_id doubles as the author id, so the user only adds email / is_active
+        models.User.email.label("user_email"), models.User.is_active.label("user_is_active"),
+        models.Post.vote_count.label("votes"),
+    ).join(models.User, models.User.id == models.Post.user_id)
+
+
+def select_post_with_user(id: int):
+    return select(models.Post).options(load_author()).where(models.Post.id == id).execution_options(populate_existing=True)
+
+
+# Prebuilt statements for the hot routes
+# Building a select() (and its cache key) on every request is Python time spent
+# for the same SQL again and again, so every query shape is built once, with
+# bindparam() placeholders, and a request only passes the values. SQLAlchemy
+# then reuses the compiled SQL from its statement cache (db_statement_cache_total on /metrics)
+LATEST_POST = select_posts_with_votes().order_by(models.Post.id.desc()).limit(1)
+POST_BY_ID = select_posts_with_votes().where(models.Post.id == bindparam("post_id", type_=Integer))
+POST_WITH_USER = select_post_with_user(bindparam("post_id", type_=Integer))
+
+
+# PUT / DELETE /posts/{id}: the ownership check is part of the WHERE clause, one
+# round trip and no window between the check and the write. No row back means
+# "not found or not yours", POST_OWNER then tells the two apart
+posts_table = models.Post.__table__
+owned_post = (posts_table.c.id == bindparam("post_id", type_=Integer), posts_table.c.user_id == bindparam("owner_id", type_=Integer))
+POST_UPDATE = (
+    update(posts_table).where(*owned_post)
+    .values(title=bindparam("new_title", type_=String), content=bindparam("new_content", type_=String), published=bindparam("new_published", type_=Boolean))
+    .returning(posts_table.c.id, posts_table.c.title, posts_table.c.content, posts_table.c.published, posts_table.c.created_at, posts_table.c.user_id)
+)
+POST_DELETE = delete(posts_table).where(*owned_post).returning(posts_table.c.id)
+POST_OWNER = select(posts_table.c.user_id).where(posts_table.c.id == bindparam("post_id", type_=Integer))
+
+
+async def missing_post_error(db: AsyncSession, id: int):
+    # after an update / delete of an owned post matched nothing
+    owner_id = await db.scalar(POST_OWNER, {"post_id": id})
+    if owner_id is None:
+        return HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post not found for id {id}")
+    return HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Unauthorized to perform the request")
+
+
+@lru_cache(maxsize=None)
+def posts_list_statement(fast_json: bool, search_mode: Optional[str], paging: str):
+    # GET /posts/ for one combination of
+    #   search_mode: None (no search), "fulltext" or "title"
+    #   paging: "offset", "first" (cursor mode first page) or "after" (a cursor was given)
+    # parameters: search, limit, offset, cursor_created_at, cursor_id
+    posts_query = select_post_rows() if fast_json else select_posts_with_votes()
+
+    rank = None
+    search = bindparam("search", type_=String)
+    if search_mode == "title":
+        # old substring match on the title, this is a sequential scan
+        posts_query = posts_query.where(models.Post.title.contains(search))
+    elif search_mode == "fulltext":
+        # full text search over title and content using the GIN index
+        ts_query = func.websearch_to_tsquery(literal_column(f"'{models.SEARCH_CONFIG}'::regconfig"), search)
+        posts_query = posts_query.where(models.Post.search_vector.op("@@")(ts_query))
+        rank = func.ts_rank(models.Post.search_vector, ts_query)
+
+    if paging == "offset":
+        # old limit/offset style, kept for the existing clients
+        if rank is not None:
+            # most relevant first
+            posts_query = posts_query.order_by(rank.desc(), models.Post.id.desc())
+        return posts_query.limit(bindparam("limit", type_=Integer)).offset(bindparam("offset", type_=Integer))
+
+    # cursor mode: newest first
+    # (search results are filtered but keep the newest first order here)
+    if paging == "after":
+        cursor_key = tuple_(bindparam("cursor_created_at", type_=models.Post.created_at.type), bindparam("cursor_id", type_=Integer))
+        posts_query = posts_query.where(tuple_(models.Post.created_at, models.Post.id) < cursor_key)
+    return posts_query.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(bindparam("limit", type_=Integer))
+
+
+@lru_cache(maxsize=None)
+def feed_statement(fast_json: bool, after: bool):
+    # GET /posts/feed, parameters: limit, cursor_hot_score, cursor_id
+    posts_query = select_post_rows().add_columns(models.Post.hot_score) if fast_json else select_posts_with_votes()
+    if after:
+        cursor_key = tuple_(bindparam("cursor_hot_score", type_=Float), bindparam("cursor_id", type_=Integer))
+        posts_query = posts_query.where(tuple_(models.Post.hot_score, models.Post.id) < cursor_key)
+    return posts_query.order_by(models.Post.hot_score.desc(), models.Post.id.desc()).limit(bindparam("limit", type_=Integer))
+
+
+def etag_response(request: Request, cached):
+    # cached is the (body, etag) pair from post_response_cache
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def cache_post_response(key, post_with_vote_count, generation):
+    # generation: post_response_cache.generation(key) taken before the query
+    body = schemas.PostWithVote.model_validate(post_with_vote_count).model_dump_json().encode()
+    cached = (body, make_etag(body))
+    post_response_cache.set(key, cached, generation)
+    return cached
+
+
 # @router.get("/", response_model=List[schemas.PostResponse])
 @router.get("/", response_model=List[schemas.PostWithVote])
-def get_all_posts(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user), limit: int = 10, page: int = 0, search: str = ""):
+async def get_all_posts(response: Response, db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user), limit: int = Query(10, ge=1, le=100), page: int = Query(0, ge=0), search: str = "", search_mode: Literal["fulltext", "title"] = "fulltext", cursor: Optional[str] = None):
     # "sqlalchemy" style with ORM
     # posts = db.query(models.Post).filter(models.Post.title.contains(search)).limit(limit).offset(page).all()
 
-    posts_with_vote_count = db.query(models.Post, func.count(models.Vote.post_id).label('votes')).join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).filter(models.Post.title.contains(search)).limit(limit).offset(page).all()
+    fast_json = settings.fast_json_responses
+    params = {"search": search, "limit": limit, "offset": page}
+
+    if cursor is None:
+        paging = "offset"
+    elif cursor:
+        # cursor mode: "?cursor=" for the first page then pass the X-Next-Cursor
+        # header value of every response to get the next page
+        paging = "after"
+        params["cursor_created_at"], params["cursor_id"] = pagination.decode_post_cursor(cursor)
+    else:
+        paging = "first"
+
+    posts_query = posts_list_statement(fast_json, (search_mode if search else None), paging)
+    return await post_list_response(db, response, posts_query, fast_json, limit, cursor_columns=None if cursor is None else ("created_at", "id"), params=params)
+
+
+@router.get("/feed", response_model=List[schemas.PostWithVote])
+async def get_feed(response: Response, db: AsyncSession = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user), limit: int = Query(10, ge=1, le=100), cursor: Optional[str] = None):
+    # "hot" posts first (see feed.py), an index range scan on (hot_score, id)
+    # pass the X-Next-Cursor header value as ?cursor= for the next page
+    fast_json = settings.fast_json_responses
+    params = {"limit": limit}
+    if cursor:
+        params["cursor_hot_score"], params["cursor_id"] = pagination.decode_feed_cursor(cursor)
+    return await post_list_response(db, response, feed_statement(fast_json, bool(cursor)), fast_json, limit, cursor_columns=("hot_score", "id"), params=params)
+
+
+EXPORT_COLUMNS = ("id", "title", "content", "published", "created_at", "user_id", "votes")
+
+
+def select_export_rows(user_id: Optional[int] = None):
+    # every post (or every post of user_id) in id order
+    export_query = select(
+        models.Post.id, models.Post.title, models.Post.content, models.Post.published, models.Post.created_at, models.Post.user_id,
+        models.Post.vote_count.label("votes"),
+    ).order_by(models.Post.id)
+    if user_id is not None:
+        export_query = export_query.where(models.Post.user_id == user_id)
+    return export_query
+
+
+@router.get("/export", response_class=StreamingResponse, responses={200: {"content": {"application/x-ndjson": {}, "text/csv": {}}}})
+async def export_posts(current_user: int = Depends(oauth2.get_current_user), format: Literal["ndjson", "csv"] = "ndjson", scope: Literal["mine", "all"] = "mine"):
+    # every post with its vote count, streamed from a server side cursor
+    # scope=all (every user's posts) is for admins only
+    if scope == "all" and current_user.email not in settings.admin_emails:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+
+    export_query = select_export_rows(current_user.id if scope == "mine" else None)
+    partitions = stream_mappings(export_query, settings.stream_batch_size, read_only=not is_pinned(current_user.id))
+    if format == "csv":
+        body, media_type = serialization.csv_lines(partitions, EXPORT_COLUMNS), "text/csv"
+    else:
+        body, media_type = serialization.ndjson_lines(partitions), "application/x-ndjson"
+    return StreamingResponse(body, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="posts.{format}"'})
+
+
+async def post_list_response(db: AsyncSession, response: Response, posts_query, fast_json: bool, limit: int, cursor_columns=None, params=None):
+    # runs a post listing, cursor_columns are the sort key columns when paging with a cursor
+    result = await db.execute(posts_query, params)
+    posts_with_vote_count = result.mappings().all() if fast_json else result.all()
+
+    headers = {}
+    if cursor_columns and posts_with_vote_count and len(posts_with_vote_count) == limit:
+        last_row = posts_with_vote_count[-1]
+        last_key = [last_row[name] if fast_json else getattr(last_row.Post, name) for name in cursor_columns]
+        headers["X-Next-Cursor"] = pagination.encode_cursor(*last_key)
+
+    if fast_json:
+        return serialization.json_response([serialization.post_with_vote(row) for row in posts_with_vote_count], headers=headers)
+    response.headers.update(headers)
     return posts_with_vote_count
 
 
-# basic process 
+# basic process
 # @router.post("/")
 
 # standard process with detault status code response
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.PostResponse)
-def create_posts(post: schemas.PostCreate, db:Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def create_posts(post: schemas.PostCreate, db: AsyncSession = Depends(get_write_db), current_user: int = Depends(oauth2.get_current_user)):
     # "sqlalchemy" style with ORM
     # new_post = models.Post(title=post.title, content=post.content)  #style-1
     # print(current_user)
-    new_post = models.Post(user_id = current_user.id, **post.dict()) #style-2 
+    new_post = models.Post(user_id = current_user.id, **post.dict()) #style-2
     # new_post.user_id = current_user.id
     db.add(new_post)
-    db.commit()
-    db.refresh(new_post)
-    return new_post
+    # a new post changes /latest (cache events go out with the commit, see invalidation.py)
+    invalidation.publish(db, "post")
+    await db.commit()
+    # reload with the server defaults (created_at ...) and the author
+    result = await db.execute(POST_WITH_USER, {"post_id": new_post.id})
+    return result.scalar_one()
 
 
 # please follow the path preceding
 # /latest  and  /{id}  both are similar
 # so follow the sequence
 
+# /latest and /{id} are served from post_response_cache with an ETag,
+# a matching If-None-Match gets a 304 without touching the database
+# they stay on the primary: the cache is shared by every user, a lagging
+# replica row cached here would hide a write from its own author
+
 @router.get("/latest", response_model=schemas.PostWithVote)
-def get_latest_post(db:Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    # "sqlalchemy" style with ORM
-    # post = db.query(models.Post).order_by(models.Post.id.desc()).first()
-    post_with_vote_count = db.query(models.Post, func.count(models.Vote.post_id).label('votes')).join(models.Vote, models.Vote.post_id == models.Post.id, isouter=True).group_by(models.Post.id).order_by(models.Post.id.desc()).first()
-    return post_with_vote_count
+async def get_latest_post(request: Request, db: AsyncSession = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+    cached = post_response_cache.get("latest")
+    if cached is None:
+        # before the query: a write committing while it runs must not leave its old row cached
+        generation = post_response_cache.generation("latest")
+        # "sqlalchemy" style with ORM
+        # post = db.query(models.Post).order_by(models.Post.id.desc()).first()
+        result = await db.execute(LATEST_POST)
+        post_with_vote_count = result.first()
+        if not post_with_vote_count:
+            return None
+        cached = cache_post_response("latest", post_with_vote_count, generation)
+    return etag_response(request, cached)
 
 @router.get("/{id}", response_model=schemas.PostWithVote)
-def get_a_post(id: int, response: Response, db: Session=Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    # "sqlalchemy" style with ORM
-    # post = db.query(models.Post).filter(models.Post.id == id).first()
-    post_with_vote_count = db.query(models.Post, func.count(models.Vote.post_id).label("votes")).join(models.Vote, models.Vote.post_id == models.Post.id).group_by(models.Post.id).filter(models.Post.id == id).first()
-    if not post_with_vote_count:
-        # standard process 
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post not found for id: {id}")
-
-    return post_with_vote_count
+async def get_a_post(id: int, request: Request, db: AsyncSession = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+    cached = post_response_cache.get(id)
+    if cached is None:
+        generation = post_response_cache.generation(id)
+        # "sqlalchemy" style with ORM
+        # post = db.query(models.Post).filter(models.Post.id == id).first()
+        result = await db.execute(POST_BY_ID, {"post_id": id})
+        post_with_vote_count = result.first()
+        if not post_with_vote_count:
+            # standard process
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post not found for id: {id}")
+        cached = cache_post_response(id, post_with_vote_count, generation)
+    return etag_response(request, cached)
 
 
 
 @router.put("/{id}", response_model=schemas.PostResponse)
-def update_posts(id: int, post: schemas.PostCreate, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    # "sqlalchemy" style with ORM
-    updated_post = db.query(models.Post).filter(models.Post.id == id)
-    get_post = updated_post.first()
-    if get_post == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post not found for id {id}")
-    
-    if get_post.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Unauthorized to perform the request")
-    
-    updated_post.update(post.dict())
-    db.commit()
-    return updated_post.first()
+async def update_posts(id: int, post: schemas.PostCreate, db: AsyncSession = Depends(get_write_db), current_user: int = Depends(oauth2.get_current_user)):
+    # UPDATE ... WHERE id AND user_id RETURNING, see POST_UPDATE
+    result = await db.execute(POST_UPDATE, {"post_id": id, "owner_id": current_user.id, "new_title": post.title, "new_content": post.content, "new_published": post.published})
+    updated_post = result.mappings().first()
+    if updated_post is None:
+        raise await missing_post_error(db, id)
+
+    invalidation.publish(db, "post", id)
+    await db.commit()
+    # only the owner gets here, so the author is the current user
+    return {**updated_post, "user": current_user}
 
 
 # standard process with detault status code response
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_posts(id: int, db:Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    # "sqlalchemy" style with ORM
-    deleted_post_query = db.query(models.Post).filter(models.Post.id == id)
-    
-    deleted_post = deleted_post_query.first()
-    
-    if deleted_post == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post not found for id {id}")
-    
-    if deleted_post.user_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"Unauthorized to perform the request")
-    
-    deleted_post_query.delete()
-    db.commit()
+async def delete_posts(id: int, db: AsyncSession = Depends(get_write_db), current_user: int = Depends(oauth2.get_current_user)):
+    # DELETE ... WHERE id AND user_id RETURNING, see POST_DELETE
+    result = await db.execute(POST_DELETE, {"post_id": id, "owner_id": current_user.id})
+    if result.first() is None:
+        raise await missing_post_error(db, id)
+
+    invalidation.publish(db, "post", id)
+    await db.commit()
     return Response(status_code=status.HTTP_204_NO_CONTENT)
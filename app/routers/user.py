@@ -1,9 +1,13 @@
-from typing import List
-from fastapi import status, HTTPException, Depends, APIRouter
-from sqlalchemy.orm import Session
+from typing import List, Optional
+from fastapi import Query, Response, status, HTTPException, Depends, APIRouter
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
  # my created model, schemas etc 
-from .. import models, schemas, utils
-from ..database import get_db
+from .. import models, pagination, schemas, ratelimit, serialization, utils
+from ..config import settings
+from ..database import get_db, stream_mappings
+from ..db_routing import get_read_db
 
 router = APIRouter(
     prefix="/users", # router prefix
@@ -11,30 +15,52 @@ router = APIRouter(
 )
 
 @router.get("/", response_model=List[schemas.UserOut])
-def get_all_users(db: Session = Depends(get_db)):
-    # "sqlalchemy" style with ORM
-    users = db.query(models.User).all()
+async def get_all_users(response: Response, db: AsyncSession = Depends(get_read_db), limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None, stream: bool = False):
+    # only the UserOut columns, never the password hashes
+    users_query = select(models.User.id, models.User.email, models.User.is_active).order_by(models.User.id)
+
+    if stream:
+        # every user as NDJSON from a server side cursor, for bulk consumers
+        partitions = stream_mappings(users_query, settings.stream_batch_size, read_only=True)
+        return StreamingResponse(serialization.ndjson_lines(partitions, serialization.user_out), media_type="application/x-ndjson")
+
+    # keyset pagination on id: pass the X-Next-Cursor header value as ?cursor=
+    if cursor:
+        users_query = users_query.where(models.User.id > pagination.decode_user_cursor(cursor))
+    result = await db.execute(users_query.limit(limit))
+    users = [serialization.user_out(row) for row in result.mappings()]
+
+    headers = {}
+    if len(users) == limit:
+        headers["X-Next-Cursor"] = pagination.encode_cursor(users[-1]["id"])
+
+    if settings.fast_json_responses:
+        return serialization.json_response(users, headers=headers)
+    response.headers.update(headers)
     return users
 
-@router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserOut, dependencies=[Depends(ratelimit.limit_by_ip("create_user"))])
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    await ratelimit.hit("create_user:account", user.email.lower())
+
     # Check if a user with this email already exists
-    existing_user = db.query(models.User).filter(models.User.email == user.email).first()
+    result = await db.execute(select(models.User).where(models.User.email == user.email))
+    existing_user = result.scalars().first()
     if existing_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
     
-    # create password hash 
-    user.password = utils.hash(user.password)
+    # create password hash (in the hashing process pool)
+    user.password = await utils.password_hasher.hash(user.password)
     new_user = models.User(**user.dict())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
 @router.get("/{id}", response_model=schemas.UserOut)
-def get_user(id: int, db:Session = Depends(get_db)):
-    user_info = db.query(models.User).filter(models.User.id == id).first()
+async def get_user(id: int, db: AsyncSession = Depends(get_read_db)):
+    user_info = await db.get(models.User, id)
     if not user_info:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User not exists for id: {id}")
-    return user_info
\ No newline at end of file
+    return user_info
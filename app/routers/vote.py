@@ -1,28 +1,202 @@
-from fastapi import FastAPI, HTTPException, status, Depends, APIRouter
-from sqlalchemy.orm import Session
+from collections import Counter
+from typing import List
+from fastapi import FastAPI, HTTPException, Response, status, Depends, APIRouter
+from sqlalchemy import Integer, any_, bindparam, cast, column, delete, func, select, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from .. import schemas, database, models, oauth2
+from .. import schemas, database, invalidation, models, oauth2, ratelimit
+from ..db_routing import get_write_db
+from ..feed import hot_score_expression
+from ..config import settings
+from ..vote_buffer import VoteBuffer
 
 router = APIRouter(
     prefix="/vote",
     tags=["Vote"]
 )
 
-@router.post("/", status_code=status.HTTP_201_CREATED)
-def vote(vote: schemas.Vote, db: Session = Depends(database.get_db), current_user: int = Depends(oauth2.get_current_user)):
-    vote_query = db.query(models.Vote).filter(models.Vote.post_id == vote.post_id, models.Vote.user_id == current_user.id)
-    found_vote = vote_query.first()
+# One statement per vote, built once (see the statement cache note in routers/post.py).
+# The votes row and posts.vote_count change together: a data modifying CTE
+# writes the votes row and the UPDATE bumps the count (and recomputes the
+# hot_score) of the post it returned, so the counter never drifts from the real
+# number of votes and there's no window between a check and the write
+votes_table, posts_table = models.Vote.__table__, models.Post.__table__
+voter_id = bindparam("voter_id", type_=Integer)
+target_post_id = bindparam("target_post_id", type_=Integer)
+
+
+def vote_count_update(changed_vote, delta):
+    # changed_vote is the CTE, no row in it -> nothing updated and no row back
+    new_count = posts_table.c.vote_count + delta
+    return (
+        update(posts_table).where(posts_table.c.id == changed_vote.c.post_id)
+        .values(vote_count=new_count, hot_score=hot_score_expression(new_count, posts_table.c.created_at))
+        .returning(posts_table.c.id, posts_table.c.vote_count)
+    )
+
+# INSERT ... SELECT FROM posts ... ON CONFLICT DO NOTHING: the vote is only
+# written when the post exists and the user hasn't voted on it yet
+ADD_VOTE = vote_count_update(
+    insert(votes_table).from_select(["user_id", "post_id"], select(voter_id, posts_table.c.id).where(posts_table.c.id == target_post_id))
+    .on_conflict_do_nothing().returning(votes_table.c.post_id).cte("added_vote"),
+    1,
+)
+REMOVE_VOTE = vote_count_update(
+    delete(votes_table).where(votes_table.c.user_id == voter_id, votes_table.c.post_id == target_post_id)
+    .returning(votes_table.c.post_id).cte("removed_vote"),
+    -1,
+)
+# only when ADD_VOTE did nothing: 409 (already voted) or 404 (no such post)
+POST_EXISTS = select(posts_table.c.id).where(posts_table.c.id == target_post_id)
+
+@router.post("/", status_code=status.HTTP_201_CREATED, dependencies=[Depends(ratelimit.limit_by_ip("vote"))])
+async def vote(vote: schemas.Vote, response: Response, db: AsyncSession = Depends(get_write_db), current_user: int = Depends(oauth2.get_current_user)):
+    await ratelimit.hit("vote:account", current_user.id)
+
+    if settings.vote_buffer_enabled:
+        # write-behind mode: accepted now, written with the next flush
+        vote_buffer.add(current_user.id, vote.post_id, vote.dir)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Vote accepted"}
+
+    vote_params = {"voter_id": current_user.id, "target_post_id": vote.post_id}
 
     if (vote.dir == 1):
-        if found_vote:
+        result = await db.execute(ADD_VOTE, vote_params)
+        voted_post = result.first()
+        if voted_post is None:
+            if await db.scalar(POST_EXISTS, vote_params) is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post not found for id: {vote.post_id}")
             raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"user {current_user.id} hase already voted on post {vote.post_id}")
-        new_vote = models.Vote(post_id = vote.post_id, user_id = current_user.id)
-        db.add(new_vote)
-        db.commit()
+        invalidation.publish(db, "post", vote.post_id)
+        # new count for the GET /live/votes subscribers
+        invalidation.publish(db, "vote_count", [vote.post_id, voted_post.vote_count, 1])
+        await db.commit()
         return {"message": "Successfully added vote"}
     else:
-        if not found_vote:
+        result = await db.execute(REMOVE_VOTE, vote_params)
+        voted_post = result.first()
+        if voted_post is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"user {current_user.id} does not exist any vote")
-        vote_query.delete()
-        db.commit()
-        return {"message": "Successfully deleted vote"}
\ No newline at end of file
+        invalidation.publish(db, "post", vote.post_id)
+        invalidation.publish(db, "vote_count", [vote.post_id, voted_post.vote_count, -1])
+        await db.commit()
+        return {"message": "Successfully deleted vote"}
+
+
+# Set based statements of apply_votes(), built once as well. The votes go in as
+# arrays (unnest) instead of a VALUES / IN list per vote, so a statement has the
+# same few bind parameters whatever the batch size (asyncpg allows at most 32767)
+def int_array(name):
+    # typed in the SQL, asyncpg sends the parameter untyped and unnest() is overloaded
+    return cast(bindparam(name, type_=ARRAY(Integer)), ARRAY(Integer))
+
+vote_user_ids = int_array("user_ids")
+vote_post_ids = int_array("post_ids")
+
+
+def batch_votes():
+    # unnest(:user_ids, :post_ids) AS batch(user_id, post_id)
+    return func.unnest(vote_user_ids, vote_post_ids).table_valued(column("user_id", Integer), column("post_id", Integer)).render_derived(name="batch")
+
+# lock the posts against a concurrent delete (FOR KEY SHARE doesn't block voting)
+# so the insert below can't fail on the foreign key
+VOTE_BATCH_LOCK_POSTS = select(posts_table.c.id).where(posts_table.c.id == any_(vote_post_ids)).with_for_update(read=True, key_share=True)
+added_votes = batch_votes()
+VOTE_BATCH_INSERT = (
+    insert(votes_table).from_select(["user_id", "post_id"], select(added_votes.c.user_id, added_votes.c.post_id))
+    .on_conflict_do_nothing().returning(votes_table.c.user_id, votes_table.c.post_id)
+)
+removed_votes = batch_votes()
+VOTE_BATCH_DELETE = (
+    delete(votes_table).where(votes_table.c.user_id == removed_votes.c.user_id, votes_table.c.post_id == removed_votes.c.post_id)
+    .returning(votes_table.c.user_id, votes_table.c.post_id)
+)
+# post_id -> change of posts.vote_count, all posts in one UPDATE (hot_score follows the new count)
+count_deltas = (
+    func.unnest(int_array("delta_post_ids"), int_array("deltas"))
+    .table_valued(column("post_id", Integer), column("delta", Integer)).render_derived(name="deltas")
+)
+VOTE_COUNT_DELTAS = (
+    update(posts_table).where(posts_table.c.id == count_deltas.c.post_id)
+    .values(vote_count=posts_table.c.vote_count + count_deltas.c.delta, hot_score=hot_score_expression(posts_table.c.vote_count + count_deltas.c.delta, posts_table.c.created_at))
+    .returning(posts_table.c.id, posts_table.c.vote_count, count_deltas.c.delta)
+)
+
+
+def vote_arrays(keys):
+    # [(user_id, post_id), ...] -> VOTE_BATCH_INSERT / VOTE_BATCH_DELETE parameters
+    return {"user_ids": [user_id for user_id, _ in keys], "post_ids": [post_id for _, post_id in keys]}
+
+
+async def apply_vote_count_deltas(db: AsyncSession, deltas):
+    deltas = {post_id: delta for post_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    result = await db.execute(VOTE_COUNT_DELTAS, {"delta_post_ids": list(deltas), "deltas": list(deltas.values())})
+    # new counts for the GET /live/votes subscribers
+    for post_id, vote_count, delta in result.all():
+        invalidation.publish(db, "vote_count", [post_id, vote_count, delta])
+
+
+async def apply_votes(db: AsyncSession, votes):
+    # set based version of vote(), votes is {(user_id, post_id): dir}
+    # a few statements whatever the number of votes, the caller commits
+    # returns {(user_id, post_id): status}
+    statuses = {}
+
+    post_ids = sorted({post_id for _, post_id in votes})
+    result = await db.execute(VOTE_BATCH_LOCK_POSTS, {"post_ids": post_ids})
+    existing_posts = set(result.scalars().all())
+
+    adds, removes = [], []
+    for key, dir in votes.items():
+        if key[1] not in existing_posts:
+            statuses[key] = "post_not_found"
+        elif dir == 1:
+            adds.append(key)
+        else:
+            removes.append(key)
+
+    added, removed = set(), set()
+    if adds:
+        result = await db.execute(VOTE_BATCH_INSERT, vote_arrays(adds))
+        added = {tuple(row) for row in result.all()}
+    if removes:
+        result = await db.execute(VOTE_BATCH_DELETE, vote_arrays(removes))
+        removed = {tuple(row) for row in result.all()}
+
+    deltas = Counter()
+    for key in adds:
+        statuses[key] = "added" if key in added else "already_voted"
+        deltas[key[1]] += key in added
+    for key in removes:
+        statuses[key] = "deleted" if key in removed else "not_voted"
+        deltas[key[1]] -= key in removed
+    await apply_vote_count_deltas(db, deltas)
+    for post_id in sorted({post_id for _, post_id in added | removed}):
+        invalidation.publish(db, "post", post_id)
+
+    return statuses
+
+
+# started / flushed by the app lifespan when settings.vote_buffer_enabled
+vote_buffer = VoteBuffer(apply_votes, settings.vote_buffer_flush_interval_ms / 1000, settings.vote_buffer_max_size)
+
+
+@router.post("/batch", response_model=List[schemas.VoteResult])
+async def vote_batch(votes: List[schemas.Vote], db: AsyncSession = Depends(get_write_db), current_user: int = Depends(oauth2.get_current_user)):
+    # replay of queued votes in one transaction, one result per item in the same order
+    if len(votes) > settings.vote_batch_max_items:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"At most {settings.vote_batch_max_items} votes per batch")
+
+    # the last vote for a post wins, like applying them one by one would
+    last_index = {vote.post_id: index for index, vote in enumerate(votes)}
+    statuses = await apply_votes(db, {(current_user.id, vote.post_id): vote.dir for vote in votes})
+    await db.commit()
+
+    return [
+        schemas.VoteResult(post_id=vote.post_id, dir=vote.dir, status=statuses[(current_user.id, vote.post_id)] if last_index[vote.post_id] == index else "superseded")
+        for index, vote in enumerate(votes)
+    ]
@@ -18,6 +18,10 @@ class UserOut(BaseModel):
     email: EmailStr
     is_active: bool
 
+    # also validated from the ORM User of a post (PostWithVote.model_validate)
+    class Config:
+        from_attributes = True
+
 
 class UserLogin(BaseModel):
     email: EmailStr
@@ -74,4 +78,12 @@ class PostWithVote(BaseModel):
 
 class Vote(BaseModel):
     post_id: int
-    dir: conint(le=1)
\ No newline at end of file
+    dir: conint(le=1)
+
+
+class VoteResult(BaseModel):
+    post_id: int
+    dir: int
+    # added, already_voted, deleted, not_voted, post_not_found
+    # or superseded (a later item in the same batch was for the same post)
+    status: str
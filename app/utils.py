@@ -1,9 +1,107 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+from .config import settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+def make_pwd_context(rounds: int):
+    # new hashes use exactly `rounds`, and hashes made with any other cost
+    # are reported by verify_and_update so they can be upgraded on login
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds)
+
+pwd_context = make_pwd_context(settings.bcrypt_rounds)
 
 def hash(password):
     return pwd_context.hash(password)
 
 def verify(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+# these run inside the hashing worker processes, so they have to be plain module level functions
+@lru_cache(maxsize=None)
+def _worker_context(rounds):
+    return make_pwd_context(rounds)
+
+def _hash_in_worker(password, rounds):
+    return _worker_context(rounds).hash(password)
+
+def _verify_and_update_in_worker(plain_password, hashed_password, rounds):
+    return _worker_context(rounds).verify_and_update(plain_password, hashed_password)
+
+
+class PasswordHasher:
+    # runs bcrypt in a dedicated process pool so a login burst can't starve the
+    # request workers, at most `max_concurrency` hashes run at once and at most
+    # `max_queue` more wait for a slot, anything beyond that gets a 503
+    def __init__(self, workers: int, max_concurrency: int, max_queue: int):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.peak_waiting = 0
+
+    def _get_executor(self):
+        # workers == 0 falls back to the threadpool (handy for local development)
+        if self.workers and self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def _run(self, fn, *args):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server busy, try again", headers={"Retry-After": "1"})
+
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            executor = self._get_executor()
+            if executor is None:
+                return await run_in_threadpool(fn, *args)
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash_in_worker, password, settings.bcrypt_rounds)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str):
+        # -> (verified, new_hash), new_hash is set when the stored hash uses an old bcrypt cost
+        return await self._run(_verify_and_update_in_worker, plain_password, hashed_password, settings.bcrypt_rounds)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "peak_waiting": self.peak_waiting,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher(settings.password_hash_workers, settings.password_hash_max_concurrency, settings.password_hash_max_queue)
@@ -0,0 +1,122 @@
+# Write-behind buffer for POST /vote/ (settings.vote_buffer_enabled)
+#
+# Instead of a transaction per vote, votes are kept in memory keyed by
+# (user_id, post_id) and written in bulk (routers.vote.apply_votes, a handful of
+# set based statements) every vote_buffer_flush_interval_ms, or as soon as
+# vote_buffer_max_size distinct votes are waiting, at most vote_buffer_max_size
+# votes per transaction. Repeated votes of a user on the same post coalesce,
+# the last one wins.
+#
+# Durability semantics:
+#   - POST /vote/ answers 202 once the vote is in the buffer, not when it's in postgres
+#   - a graceful shutdown (lifespan exit) flushes everything (a flush in progress
+#     is waited for, a cancelled one puts its votes back); if that last flush
+#     fails (database down) the votes are lost, logged with their count
+#   - a crash / kill -9 loses the votes of the current window (at most one interval)
+#   - there is no 404 / 409 feedback: votes on missing posts, duplicate up-votes
+#     and deletes of missing votes are dropped silently at flush time
+#   - a failed flush puts the votes back and retries on the next interval; if
+#     the database stays down the buffer fills up to 10x max_size, then new
+#     votes get a 503 (the next flush writes them all, max_size at a time)
+#   - each worker process has its own buffer
+import asyncio
+import itertools
+import logging
+import math
+import time
+
+from fastapi import HTTPException, status
+
+from . import database, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class VoteBuffer:
+    def __init__(self, apply_votes, flush_interval: float, max_size: int):
+        # apply_votes(db, {(user_id, post_id): dir}) -> {(user_id, post_id): status}
+        self.apply_votes = apply_votes
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, user_id: int, post_id: int, dir: int):
+        if len(self._pending) >= self.max_size * 10:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Vote buffer full, try again", headers={"Retry-After": "1"})
+        self._pending[(user_id, post_id)] = dir
+        metrics.VOTE_BUFFER_DEPTH.set(len(self._pending))
+        if len(self._pending) >= self.max_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._flush_lock:
+            # one transaction per max_size votes, a backlog (up to 10x max_size
+            # after an outage) drains in several bounded ones
+            for _ in range(math.ceil(len(self._pending) / self.max_size)):
+                if not self._pending:
+                    break
+                await self._write(self._take(self.max_size))
+
+    def _take(self, count):
+        # the `count` oldest pending votes
+        keys = list(itertools.islice(self._pending, count))
+        return {key: self._pending.pop(key) for key in keys}
+
+    async def _write(self, batch):
+        start = time.perf_counter()
+        try:
+            async with database.db_session() as db:
+                # apply_votes publishes the cache invalidations of the changed posts
+                await self.apply_votes(db, batch)
+                await db.commit()
+        except BaseException:
+            # failed or cancelled: put the batch back, newer votes that arrived
+            # meanwhile win over its ones. Applying a batch again is harmless
+            # even if its commit went through (adds are ON CONFLICT DO NOTHING,
+            # removes of missing votes do nothing)
+            for key, dir in batch.items():
+                self._pending.setdefault(key, dir)
+            metrics.VOTE_BUFFER_FLUSHES.labels("error").inc()
+            raise
+        finally:
+            metrics.VOTE_BUFFER_FLUSH_LATENCY.observe(time.perf_counter() - start)
+            metrics.VOTE_BUFFER_DEPTH.set(len(self._pending))
+
+        metrics.VOTE_BUFFER_FLUSHES.labels("ok").inc()
+        metrics.VOTE_BUFFER_FLUSHED_VOTES.inc(len(batch))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("vote buffer flush failed, %s votes kept for the next try", len(self._pending))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            # let a flush in progress finish, the task then gets cancelled
+            # while it waits for the next one
+            async with self._flush_lock:
+                self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # last flush on shutdown, nothing retries it: log what is lost and let
+        # the rest of the shutdown go on
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("vote buffer final flush failed, %s votes lost", len(self._pending))
@@ -0,0 +1,123 @@
+# Startup warm-up and readiness
+# Right after a deploy the first requests would pay for opening the pooled
+# connections (TCP + auth), compiling the hot SQL statements and building the
+# pydantic / orjson response path. warm_up() does all of that once at startup,
+# in the background so /healthz answers right away, and GET /readyz only says
+# ready when it's done and the database answers, so the load balancer sends
+# traffic to warm workers only.
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from fastapi import Response
+from sqlalchemy import select, text
+
+from . import database, models, schemas
+from .config import settings
+from .routers import post, vote
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    def __init__(self):
+        self.warmed_up = False
+        self.error = None
+
+
+readiness = Readiness()
+
+
+async def open_connections(count, read_only=False):
+    # check out `count` connections at the same time so the pool really opens
+    # that many, then hand them all back (they stay open in the pool)
+    opened = 0
+    all_open = asyncio.Event()
+
+    async def hold_connection():
+        nonlocal opened
+        async with database.db_session(read_only=read_only) as db:
+            try:
+                await db.execute(text("SELECT 1"))
+            except BaseException:
+                # don't leave the others waiting for a connection that won't come
+                all_open.set()
+                raise
+            opened += 1
+            if opened == count:
+                all_open.set()
+            await all_open.wait()
+
+    await asyncio.gather(*(hold_connection() for _ in range(count)))
+
+
+def hot_statements():
+    # (statement, parameters) behind the busiest routes, the parameter values
+    # don't matter: the compiled SQL is cached per statement shape
+    fast_json = settings.fast_json_responses
+    list_params = {"search": "", "limit": 10, "offset": 0, "cursor_created_at": datetime.now(timezone.utc), "cursor_id": 0}
+    statements = [(post.posts_list_statement(fast_json, None, paging), list_params) for paging in ("offset", "first", "after")]
+    statements += [(post.feed_statement(fast_json, after), {"limit": 10, "cursor_hot_score": 0.0, "cursor_id": 0}) for after in (False, True)]
+    statements += [
+        (post.LATEST_POST, None),
+        (post.POST_BY_ID, {"post_id": 0}),
+        (post.POST_WITH_USER, {"post_id": 0}),
+        (vote.POST_EXISTS, {"target_post_id": 0}),
+        (select(models.User).where(models.User.email == ""), None),
+        (select(models.User.id, models.User.email, models.User.is_active).order_by(models.User.id).limit(1), None),
+    ]
+    return statements
+
+
+async def run_hot_statements(read_only=False):
+    async with database.db_session(read_only=read_only) as db:
+        for statement, params in hot_statements():
+            result = await db.execute(statement, params)
+            result.all()
+        await db.get(models.User, 0)
+
+        # the response side: pydantic validators / serializers and orjson
+        result = await db.execute(post.LATEST_POST)
+        row = result.first()
+        if row is not None:
+            schemas.PostWithVote.model_validate(row).model_dump_json()
+        await post.post_list_response(db, Response(), post.select_post_rows().limit(1), True, 1)
+
+
+async def warm_up():
+    # retried until it works, the database may come up after the app
+    delay = 1
+    while True:
+        try:
+            if settings.db_warmup_connections:
+                await open_connections(settings.db_warmup_connections)
+                if database.replica_sessionmakers:
+                    # read only sessions go round robin over the replicas
+                    await open_connections(settings.db_warmup_connections * len(database.replica_sessionmakers), read_only=True)
+            await run_hot_statements()
+            if database.replica_sessionmakers:
+                await run_hot_statements(read_only=True)
+            readiness.warmed_up, readiness.error = True, None
+            logger.info("warm-up done")
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            readiness.error = repr(error)
+            logger.exception("warm-up failed, retrying in %s seconds", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+
+async def database_reachable():
+    # one round trip on the primary, bounded so a hung database fails the probe
+    async def ping():
+        async with database.db_session() as db:
+            await db.execute(text("SELECT 1"))
+
+    try:
+        await asyncio.wait_for(ping(), settings.readiness_db_timeout_seconds)
+        return True
+    except Exception as error:
+        readiness.error = repr(error)
+        return False
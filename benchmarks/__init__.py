@@ -0,0 +1,7 @@
+# Load test / benchmark suite
+#
+#   python -m benchmarks seed --users 10000 --posts 1000000 --votes 20000000
+#   python -m benchmarks run --base-url http://localhost:8000 --output results.json
+#   python -m benchmarks compare baseline.json results.json
+#
+# see README.md for details
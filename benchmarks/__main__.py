@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from . import explain, load, seed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="migrate and fill the database with synthetic data")
+    seed_parser.add_argument("--users", type=int, default=10_000)
+    seed_parser.add_argument("--posts", type=int, default=100_000)
+    seed_parser.add_argument("--votes", type=int, default=2_000_000)
+    seed_parser.add_argument("--days", type=int, default=365, help="spread created_at over this many days")
+    seed_parser.add_argument("--seed", type=int, default=42)
+
+    run_parser = commands.add_parser("run", help="drive every route and report latency / throughput")
+    run_parser.add_argument("--base-url", default="http://localhost:8000")
+    run_parser.add_argument("--users", type=int, default=10_000, help="same value as used for seed")
+    run_parser.add_argument("--posts", type=int, default=100_000, help="same value as used for seed")
+    run_parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    run_parser.add_argument("--concurrency", type=int, default=32)
+    run_parser.add_argument("--only", nargs="*", help="endpoint names to run")
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+
+    explain_parser = commands.add_parser("explain", help="fail if a hot query is planned as a sequential scan")
+    explain_parser.add_argument("--only", nargs="*", help="query names to check")
+    explain_parser.add_argument("--verbose", action="store_true", help="print every plan")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "seed":
+        seed.seed(args.users, args.posts, args.votes, days=args.days, random_seed=args.seed)
+    elif args.command == "run":
+        report = asyncio.run(load.run(args.base_url, args.users, args.posts, args.requests, args.concurrency, only=args.only, random_seed=args.seed))
+        output = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+    elif args.command == "explain":
+        failures = explain.check(only=args.only, verbose=args.verbose)
+        return 1 if failures else 0
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        for row in load.compare(baseline, current):
+            print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
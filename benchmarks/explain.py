@@ -0,0 +1,134 @@
+# Query plan checks for the hot queries
+# Takes the statements the routers run (the prebuilt ones and the statement
+# factories of routers/post.py and routers/vote.py, every search / paging
+# combination), EXPLAINs them against the seeded database and fails when
+# postgres plans a sequential scan of posts / votes / users for any of them,
+# e.g. after an index got lost or a query changed shape. Shapes that scan by
+# design are listed in KNOWN_SEQ_SCANS. Run it after `python -m benchmarks seed`,
+# `python -m benchmarks explain` or tests/test_explain.py.
+import json
+
+from sqlalchemy import func, select
+
+from app import models
+from app.database import engine
+from app.routers import post as post_router
+from app.routers import vote as vote_router
+
+from .seed import bench_email
+
+# a sequential scan of any of these is a failure
+CHECKED_TABLES = ("posts", "votes", "users")
+
+# reachable query shapes that scan by design: name -> (tables, why), a seq scan
+# of those tables is reported, not failed (any other table still fails)
+KNOWN_SEQ_SCANS = {}
+for fast_json in ("fast", "orm"):
+    KNOWN_SEQ_SCANS[f"posts_list[{fast_json},none,offset]"] = ({"posts"}, "limit/offset without a search has no ORDER BY, postgres reads the first rows it finds")
+    for paging in ("offset", "first", "after"):
+        KNOWN_SEQ_SCANS[f"posts_list[{fast_json},title,{paging}]"] = ({"posts"}, "search_mode=title is a substring match on the title, no index can serve it")
+        KNOWN_SEQ_SCANS[f"posts_list[{fast_json},fulltext,{paging}]"] = ({"users"}, "the GIN index finds the posts, hundreds of expected matches get their authors by a hash join")
+
+
+def queries(post, user_id, email):
+    # name -> (statement, parameters), the statements the routers run with
+    # their parameters bound to real rows of the seeded database (post is one
+    # posts row). Parameters are passed at execution like the routers do
+    # (INSERT / UPDATE / DELETE have no .params())
+    list_params = {
+        "search": str(post.id), "limit": 10, "offset": 0,
+        "cursor_created_at": post.created_at, "cursor_id": post.id,
+    }
+    vote_params = {"voter_id": user_id, "target_post_id": post.id}
+    batch_post_ids = [post.id, post.id + 1]
+    batch_votes = [(user_id, post_id) for post_id in batch_post_ids]
+
+    statements = {}
+    # GET /posts/, every fast json / search / paging combination
+    for fast_json in (True, False):
+        for search_mode in (None, "fulltext", "title"):
+            for paging in ("offset", "first", "after"):
+                name = f"posts_list[{'fast' if fast_json else 'orm'},{search_mode or 'none'},{paging}]"
+                statements[name] = (post_router.posts_list_statement(fast_json, search_mode, paging), list_params)
+    # GET /posts/feed
+    for fast_json in (True, False):
+        for after in (False, True):
+            name = f"feed[{'fast' if fast_json else 'orm'},{'after' if after else 'first'}]"
+            statements[name] = (post_router.feed_statement(fast_json, after), {"limit": 10, "cursor_hot_score": post.hot_score, "cursor_id": post.id})
+
+    User = models.User
+    statements.update({
+        # GET /posts/latest, GET /posts/{id}, after POST /posts/
+        "post_latest": (post_router.LATEST_POST, None),
+        "post_by_id": (post_router.POST_BY_ID, {"post_id": post.id}),
+        "post_with_user": (post_router.POST_WITH_USER, {"post_id": post.id}),
+        # GET /posts/export?scope=mine
+        "posts_export_mine": (post_router.select_export_rows(user_id), None),
+        # PUT / DELETE /posts/{id} and the 404 / 403 follow-up
+        "post_update": (post_router.POST_UPDATE, {"post_id": post.id, "owner_id": user_id, "new_title": "title", "new_content": "content", "new_published": True}),
+        "post_delete": (post_router.POST_DELETE, {"post_id": post.id, "owner_id": user_id}),
+        "post_owner": (post_router.POST_OWNER, {"post_id": post.id}),
+        # POST /vote/ and its 404 / 409 follow-up
+        "vote_add": (vote_router.ADD_VOTE, vote_params),
+        "vote_remove": (vote_router.REMOVE_VOTE, vote_params),
+        "vote_post_exists": (vote_router.POST_EXISTS, vote_params),
+        # POST /vote/batch and the vote buffer (apply_votes)
+        "vote_batch_lock_posts": (vote_router.VOTE_BATCH_LOCK_POSTS, {"post_ids": batch_post_ids}),
+        "vote_batch_insert": (vote_router.VOTE_BATCH_INSERT, vote_router.vote_arrays(batch_votes)),
+        "vote_batch_delete": (vote_router.VOTE_BATCH_DELETE, vote_router.vote_arrays(batch_votes)),
+        "vote_count_deltas": (vote_router.VOTE_COUNT_DELTAS, {"delta_post_ids": batch_post_ids, "deltas": [1, -1]}),
+        # /login, get_current_user on a cache miss, GET /users/{id} and GET /users/
+        "user_by_email": (select(User).where(User.email == email), None),
+        "user_by_id": (select(User).where(User.id == user_id), None),
+        "users_next_page": (select(User.id, User.email, User.is_active).where(User.id > user_id).order_by(User.id).limit(100), None),
+    })
+    return statements
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def explain(connection, statement, params=None):
+    # same SQL and parameter values a request sends, IN lists expanded
+    compiled = statement.compile(dialect=engine.dialect, compile_kwargs={"render_postcompile": True})
+    plan = connection.exec_driver_sql("EXPLAIN (FORMAT JSON) " + compiled.string, compiled.construct_params(params)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def check(only=None, verbose=False):
+    # prints one line per query, returns the names of the failing ones
+    with engine.connect() as connection:
+        max_id = connection.execute(select(func.max(models.Post.id))).scalar()
+        if not max_id:
+            raise SystemExit("no posts, run `python -m benchmarks seed` first")
+        post = connection.execute(
+            select(models.Post.id, models.Post.user_id, models.Post.created_at, models.Post.hot_score)
+            .where(models.Post.id >= max_id // 2).order_by(models.Post.id).limit(1)
+        ).one()
+
+        failures = []
+        for name, (statement, params) in queries(post, post.user_id, bench_email(1)).items():
+            if only and name not in only:
+                continue
+            plan = explain(connection, statement, params)
+            seq_scans = sorted({node["Relation Name"] for node in plan_nodes(plan) if node["Node Type"] == "Seq Scan" and node.get("Relation Name") in CHECKED_TABLES})
+            if not seq_scans:
+                result = "ok"
+            elif set(seq_scans) <= KNOWN_SEQ_SCANS.get(name, (set(), None))[0]:
+                result = "known"
+            else:
+                result = "FAIL"
+                failures.append(name)
+            detail = f"seq scan on {', '.join(seq_scans)}" if seq_scans else ""
+            if result == "known":
+                detail += f" ({KNOWN_SEQ_SCANS[name][1]})"
+            print(f"{result:5}  {name:32} {detail}".rstrip())
+            if verbose or result == "FAIL":
+                print(json.dumps(plan, indent=2))
+        # EXPLAIN of the writes doesn't run them, nothing to roll back
+    return failures
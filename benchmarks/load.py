@@ -0,0 +1,173 @@
+# Concurrent HTTP load generator
+# Drives every route of app/routers one after the other, `requests` calls per
+# route with `concurrency` clients, and reports throughput and latency per route.
+import asyncio
+import random
+import subprocess
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+
+from .seed import BENCH_PASSWORD, bench_email
+
+
+class Endpoint:
+    def __init__(self, name, method, path, body=None, form=None, auth=True, expected=(200, 201, 204, 304)):
+        self.name = name
+        self.method = method
+        # path / body / form are callables taking (context, rng) so every request can differ
+        self.path = path
+        self.body = body
+        self.form = form
+        self.auth = auth
+        self.expected = expected
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, statuses, expected, elapsed):
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for code, count in statuses.items() if code not in expected),
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())},
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+def endpoints(users, posts):
+    # ordered so the write routes have something to work on:
+    # create_posts fills context["own_posts"], update / delete use them
+    random_post = lambda ctx, rng: f"/posts/{rng.randint(1, posts)}"
+    return [
+        Endpoint("root", "GET", lambda ctx, rng: "/", auth=False),
+        Endpoint("login", "POST", lambda ctx, rng: "/login", auth=False,
+                 form=lambda ctx, rng: {"username": bench_email(rng.randint(1, users)), "password": BENCH_PASSWORD}),
+        Endpoint("get_all_posts", "GET", lambda ctx, rng: f"/posts/?limit=10&page={rng.randint(0, 1000)}"),
+        Endpoint("get_all_posts_deep_offset", "GET", lambda ctx, rng: f"/posts/?limit=10&page={rng.randint(posts // 2, posts)}"),
+        Endpoint("get_all_posts_cursor", "GET", lambda ctx, rng: "/posts/?limit=10&cursor="),
+        Endpoint("get_all_posts_search", "GET", lambda ctx, rng: f"/posts/?limit=10&search={rng.choice(['postgres', 'cache latency', 'async worker'])}"),
+        Endpoint("get_feed", "GET", lambda ctx, rng: "/posts/feed?limit=10"),
+        Endpoint("export_posts", "GET", lambda ctx, rng: "/posts/export?format=ndjson"),
+        Endpoint("get_latest_post", "GET", lambda ctx, rng: "/posts/latest"),
+        Endpoint("get_a_post", "GET", random_post, expected=(200, 304, 404)),
+        Endpoint("create_posts", "POST", lambda ctx, rng: "/posts/",
+                 body=lambda ctx, rng: {"title": f"load test {rng.random()}", "content": "created by the benchmark"}),
+        Endpoint("update_posts", "PUT", lambda ctx, rng: f"/posts/{rng.choice(ctx['own_posts'])}",
+                 body=lambda ctx, rng: {"title": f"updated {rng.random()}", "content": "updated by the benchmark"}),
+        Endpoint("vote", "POST", lambda ctx, rng: "/vote/", expected=(201, 202, 404, 409),
+                 body=lambda ctx, rng: {"post_id": rng.randint(1, posts), "dir": rng.randint(0, 1)}),
+        Endpoint("vote_batch", "POST", lambda ctx, rng: "/vote/batch",
+                 body=lambda ctx, rng: [{"post_id": rng.randint(1, posts), "dir": rng.randint(0, 1)} for _ in range(50)]),
+        Endpoint("get_all_users", "GET", lambda ctx, rng: "/users/", auth=False),
+        Endpoint("get_user", "GET", lambda ctx, rng: f"/users/{rng.randint(1, users)}", auth=False),
+        Endpoint("create_user", "POST", lambda ctx, rng: "/users/", auth=False,
+                 body=lambda ctx, rng: {"email": f"load-{ctx['run_id']}-{rng.getrandbits(48)}@example.com", "password": BENCH_PASSWORD}),
+        Endpoint("delete_posts", "DELETE", lambda ctx, rng: f"/posts/{ctx['own_posts'].pop()}"),
+    ]
+
+
+async def login(client, user_id):
+    response = await client.post("/login", data={"username": bench_email(user_id), "password": BENCH_PASSWORD})
+    response.raise_for_status()
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def drive(client, endpoint, context, auth_headers, requests, concurrency, rng):
+    latencies = []
+    statuses = Counter()
+    remaining = iter(range(requests))
+
+    async def client_loop(headers):
+        for _ in remaining:
+            if endpoint.name == "delete_posts" and not context["own_posts"]:
+                break
+            kwargs = {"headers": headers if endpoint.auth else None}
+            if endpoint.body:
+                kwargs["json"] = endpoint.body(context, rng)
+            if endpoint.form:
+                kwargs["data"] = endpoint.form(context, rng)
+            path = endpoint.path(context, rng)
+            start = time.perf_counter()
+            try:
+                response = await client.request(endpoint.method, path, **kwargs)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+                response = None
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+            if endpoint.name == "create_posts" and response is not None and status == 201:
+                context["own_posts"].append(response.json()["id"])
+
+    # own_posts belong to the first benchmark user, so the routes working on them use its token
+    owner_only = endpoint.name in ("create_posts", "update_posts", "delete_posts")
+    started = time.perf_counter()
+    await asyncio.gather(*(client_loop(auth_headers[0 if owner_only else i % len(auth_headers)]) for i in range(concurrency)))
+    return summarize(latencies, statuses, endpoint.expected, time.perf_counter() - started)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(base_url, users, posts, requests, concurrency, only=None, random_seed=42):
+    rng = random.Random(random_seed)
+    context = {"own_posts": [], "run_id": int(time.time())}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    report = {
+        "meta": {
+            "git_commit": git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "base_url": base_url,
+            "users": users,
+            "posts": posts,
+            "requests_per_endpoint": requests,
+            "concurrency": concurrency,
+        },
+        "endpoints": {},
+    }
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        # a few distinct users so caches keyed by user see realistic traffic
+        auth_headers = [await login(client, user_id) for user_id in range(1, min(users, concurrency) + 1)]
+        for endpoint in endpoints(users, posts):
+            if only and endpoint.name not in only:
+                continue
+            if endpoint.name == "update_posts" and not context["own_posts"]:
+                continue
+            report["endpoints"][endpoint.name] = await drive(client, endpoint, context, auth_headers, requests, concurrency, rng)
+    return report
+
+
+def compare(baseline, current):
+    # p50 / p95 / p99 and throughput change per endpoint between two reports
+    rows = []
+    for name, result in current["endpoints"].items():
+        before = baseline["endpoints"].get(name)
+        if not before:
+            continue
+        row = {"endpoint": name}
+        for key in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][key], result["latency_ms"][key]
+            row[key] = f"{old} -> {new} ms" + (f" ({(new - old) / old * 100:+.1f}%)" if old and new is not None else "")
+        row["throughput"] = f"{before['throughput_rps']} -> {result['throughput_rps']} rps"
+        rows.append(row)
+    return rows
@@ -0,0 +1,116 @@
+# Synthetic data generator
+# Migrates the database configured in .env to the latest alembic revision,
+# wipes users / posts / votes and bulk loads them again with COPY.
+import io
+import random
+from datetime import datetime, timedelta, timezone
+
+from alembic import command
+from alembic.config import Config
+
+from app import feed, utils
+from app.database import engine
+
+BENCH_PASSWORD = "benchmark-password"
+
+
+def bench_email(user_id):
+    return f"bench-user-{user_id}@example.com"
+
+
+class IteratorFile(io.TextIOBase):
+    # file like object over a generator of text lines, so COPY can stream
+    # millions of rows without building them in memory first
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            chunk, self._buffer = self._buffer, ""
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def user_rows(users, password_hash):
+    for user_id in range(1, users + 1):
+        yield f"{user_id}\t{bench_email(user_id)}\t{password_hash}\n"
+
+
+def post_rows(posts, users, days, rng):
+    now = datetime.now(timezone.utc)
+    for post_id in range(1, posts + 1):
+        created_at = now - timedelta(seconds=rng.uniform(0, days * 86400))
+        title = f"Benchmark post {post_id} about {rng.choice(WORDS)} and {rng.choice(WORDS)}"
+        content = " ".join(rng.choice(WORDS) for _ in range(30))
+        yield f"{post_id}\t{title}\t{content}\t{created_at.isoformat()}\t{rng.randint(1, users)}\n"
+
+
+def vote_rows(posts, users, votes, rng):
+    # skewed (exponential) number of votes per post, a few posts get most of them
+    average = votes / posts
+    for post_id in range(1, posts + 1):
+        count = min(users, int(rng.expovariate(1 / average))) if average else 0
+        for user_id in rng.sample(range(1, users + 1), count):
+            yield f"{user_id}\t{post_id}\n"
+
+
+WORDS = ["fastapi", "python", "postgres", "index", "cache", "latency", "async", "vote", "feed", "query",
+         "database", "server", "client", "cursor", "search", "ranking", "stream", "worker", "pool", "token"]
+
+
+def seed(users, posts, votes, days=365, random_seed=42, alembic_ini="alembic.ini"):
+    # bring the schema to head through the real migrations
+    command.upgrade(Config(alembic_ini), "head")
+
+    rng = random.Random(random_seed)
+    # every benchmark user shares one password, bcrypt it once
+    password_hash = utils.hash(BENCH_PASSWORD)
+
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("TRUNCATE votes, posts, users RESTART IDENTITY CASCADE")
+        cursor.copy_expert("COPY users (id, email, password) FROM STDIN", IteratorFile(user_rows(users, password_hash)))
+        cursor.copy_expert("COPY posts (id, title, content, created_at, user_id) FROM STDIN", IteratorFile(post_rows(posts, users, days, rng)))
+        cursor.copy_expert("COPY votes (user_id, post_id) FROM STDIN", IteratorFile(vote_rows(posts, users, votes, rng)))
+
+        # ids were given explicitly, move the sequences past them
+        cursor.execute("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM users), false)")
+        cursor.execute("SELECT setval(pg_get_serial_sequence('posts', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM posts), false)")
+
+        # denormalized columns maintained by the app
+        cursor.execute(
+            """
+            UPDATE posts SET vote_count = counts.votes
+            FROM (SELECT post_id, count(*) AS votes FROM votes GROUP BY post_id) AS counts
+            WHERE posts.id = counts.post_id
+            """
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    # initial /posts/feed ranking, the app's background job takes over from here
+    with engine.begin() as connection:
+        connection.execute(feed.hot_score_refresh_statement())
+
+    # fresh statistics for the planner
+    connection = engine.raw_connection()
+    try:
+        connection.set_isolation_level(0)
+        connection.cursor().execute("VACUUM ANALYZE users, posts, votes")
+    finally:
+        connection.close()
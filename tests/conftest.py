@@ -0,0 +1,83 @@
+# Shared fixtures
+# The request level tests run the app against the postgres configured with the
+# usual DATABASE_* variables (or .env), migrated with `alembic upgrade head`,
+# and are skipped when there is none. They only add their own users / posts,
+# so a seeded benchmark database works too.
+import os
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# app.config reads these on import, the database ones only matter without a .env
+if not (ROOT / ".env").exists():
+    for name, value in {
+        "DATABASE_HOSTNAME": "localhost",
+        "DATABASE_PORT": "5432",
+        "DATABASE_PASSWORD": "password",
+        "DATABASE_NAME": "fastapi",
+        "DATABASE_USERNAME": "postgres",
+        "SECRET_KEY": "test-secret",
+        "ALGORITHM": "HS256",
+        "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+    }.items():
+        os.environ.setdefault(name, value)
+# cheap hashes in the threadpool, no rate limits (tests/test_ratelimit.py turns them on)
+# and no background hot score job
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("HOT_SCORE_REFRESH_SECONDS", "0")
+
+
+@pytest.fixture(scope="session")
+def database():
+    # the sync engine, or a skip when there is no migrated database
+    from sqlalchemy import text
+    from app.database import engine
+
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT version_num FROM alembic_version"))
+    except Exception as error:
+        pytest.skip(f"no migrated test database ({error.__class__.__name__}), set DATABASE_* and run `alembic upgrade head`")
+    return engine
+
+
+@pytest.fixture(scope="session")
+def client(database):
+    # one app (and lifespan) for the whole session: the async engine's pooled
+    # connections belong to the event loop of the TestClient that opened them
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture
+def make_user(client):
+    # new user -> (id, Authorization headers)
+    from app import oauth2
+
+    def make_user():
+        email = f"test-{uuid.uuid4().hex[:12]}@example.com"
+        response = client.post("/users/", json={"email": email, "password": "password"})
+        assert response.status_code == 201, response.text
+        user_id = response.json()["id"]
+        token = oauth2.create_access_token({"user_id": user_id, "email": email})
+        return user_id, {"Authorization": f"Bearer {token}"}
+
+    return make_user
+
+
+@pytest.fixture
+def make_post(client):
+    def make_post(headers, title="test post"):
+        response = client.post("/posts/", json={"title": title, "content": "content"}, headers=headers)
+        assert response.status_code == 201, response.text
+        return response.json()["id"]
+
+    return make_post
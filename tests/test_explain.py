@@ -0,0 +1,19 @@
+# The EXPLAIN plan check of benchmarks/explain.py: no hot query may be planned
+# as a sequential scan of posts / votes / users (KNOWN_SEQ_SCANS aside).
+# Plans depend on the table sizes, so it needs a database seeded with
+# `python -m benchmarks seed` and is skipped on any other one.
+import pytest
+from sqlalchemy import select
+
+from app import models
+from benchmarks import explain
+from benchmarks.seed import bench_email
+
+
+def test_no_unexpected_seq_scans(database):
+    with database.connect() as connection:
+        seeded = connection.execute(select(models.User.id).where(models.User.email == bench_email(1))).first()
+    if seeded is None:
+        pytest.skip("not a seeded database, run `python -m benchmarks seed` first")
+    # one line per query is printed, shown by pytest when it fails
+    assert explain.check() == []
@@ -0,0 +1,33 @@
+# Smoke test: the app, the models (alembic/env.py) and the benchmarks have to
+# import cleanly, circular imports between app modules only show up here.
+# Every module is imported in a fresh interpreter, a cycle depends on which
+# module is imported first (e.g. app.feed -> app.database -> app.metrics).
+# Nothing connects to the database, the engines are created lazily.
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ENV = {
+    "DATABASE_HOSTNAME": "localhost",
+    "DATABASE_PORT": "5432",
+    "DATABASE_PASSWORD": "password",
+    "DATABASE_NAME": "fastapi",
+    "DATABASE_USERNAME": "postgres",
+    "SECRET_KEY": "test-secret",
+    "ALGORITHM": "HS256",
+    "ACCESS_TOKEN_EXPIRE_MINUTES": "30",
+}
+
+
+@pytest.mark.parametrize("module", ["app.database", "app.models", "app.feed", "app.main", "benchmarks.explain"])
+def test_import(module):
+    result = subprocess.run(
+        [sys.executable, "-c", f"import {module}"],
+        cwd=ROOT, env={**ENV, **os.environ}, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
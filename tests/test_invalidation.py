@@ -0,0 +1,45 @@
+# Cache invalidation bus: where the listener connects, and that a NOTIFY from
+# another process reaches the registered handler
+import json
+import time
+
+from sqlalchemy import func, select
+
+from app import invalidation
+from app.config import settings
+
+
+def test_listen_url_defaults_to_the_database(monkeypatch, caplog):
+    monkeypatch.setattr(settings, "cache_invalidation_listen_url", "")
+    monkeypatch.setattr(settings, "db_pgbouncer_mode", False)
+    assert invalidation.listen_url("postgresql://primary/db") == "postgresql://primary/db"
+    assert caplog.text == ""
+
+
+def test_listen_url_setting_wins(monkeypatch, caplog):
+    monkeypatch.setattr(settings, "cache_invalidation_listen_url", "postgresql://direct/db")
+    monkeypatch.setattr(settings, "db_pgbouncer_mode", True)
+    assert invalidation.listen_url("postgresql://pgbouncer/db") == "postgresql://direct/db"
+    assert caplog.text == ""
+
+
+def test_pgbouncer_mode_without_listen_url_warns(monkeypatch, caplog):
+    monkeypatch.setattr(settings, "cache_invalidation_listen_url", "")
+    monkeypatch.setattr(settings, "db_pgbouncer_mode", True)
+    assert invalidation.listen_url("postgresql://pgbouncer/db") == "postgresql://pgbouncer/db"
+    assert "cache_invalidation_listen_url" in caplog.text
+
+
+def test_remote_event_reaches_the_handler(client, database, monkeypatch):
+    # the app lifespan started the listener, this NOTIFY looks like another worker's
+    received = []
+    monkeypatch.setitem(invalidation.bus.handlers, "test", invalidation.CacheHandler(received.append))
+    payload = json.dumps({"origin": "another-worker", "events": [["test", 42]]})
+
+    deadline = time.monotonic() + 10
+    while not received and time.monotonic() < deadline:
+        # again until it arrives, the listener may still be connecting
+        with database.begin() as connection:
+            connection.execute(select(func.pg_notify(invalidation.bus.channel, payload)))
+        time.sleep(0.2)
+    assert received and set(received) == {42}
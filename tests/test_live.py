@@ -0,0 +1,25 @@
+# GET /live/votes: the first counts a subscriber gets
+from contextlib import asynccontextmanager
+
+from app import database, live
+
+
+def test_initial_counts_come_from_the_primary(client, make_user, make_post, monkeypatch):
+    _, headers = make_user()
+    post_id = make_post(headers)
+    assert client.post("/vote/", json={"post_id": post_id, "dir": 1}, headers=headers).status_code == 201
+
+    # a replica may not have the vote yet, only the primary is guaranteed to
+    sessions = []
+    db_session = database.db_session
+
+    @asynccontextmanager
+    async def recording_db_session(read_only=False):
+        sessions.append(read_only)
+        async with db_session(read_only) as db:
+            yield db
+
+    monkeypatch.setattr(database, "db_session", recording_db_session)
+    counts = client.portal.call(live.current_vote_counts, {post_id, 0})
+    assert counts == {post_id: 1}
+    assert sessions == [False]
@@ -0,0 +1,60 @@
+# GET /posts/{id} and GET /posts/latest: cached body with an ETag, 304 on a
+# matching If-None-Match, and a vote drops the cached body (new count, new ETag)
+import pytest
+
+
+@pytest.fixture
+def author(make_user):
+    return make_user()
+
+
+def vote(client, headers, post_id, dir=1):
+    response = client.post("/vote/", json={"post_id": post_id, "dir": dir}, headers=headers)
+    assert response.status_code == 201, response.text
+
+
+@pytest.mark.parametrize("path", ["/posts/{id}", "/posts/latest"])
+def test_etag_and_304(client, author, make_post, path):
+    _, headers = author
+    post_id = make_post(headers)
+
+    first = client.get(path.format(id=post_id), headers=headers)
+    assert first.status_code == 200, first.text
+    assert first.json()["Post"]["id"] == post_id
+    assert first.json()["votes"] == 0
+    etag = first.headers["ETag"]
+
+    # served from the cache this time
+    cached = client.get(path.format(id=post_id), headers=headers)
+    assert cached.status_code == 200
+    assert cached.headers["ETag"] == etag
+    assert cached.content == first.content
+
+    not_modified = client.get(path.format(id=post_id), headers={**headers, "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["ETag"] == etag
+    assert not_modified.content == b""
+
+
+@pytest.mark.parametrize("path", ["/posts/{id}", "/posts/latest"])
+def test_vote_invalidates(client, author, make_user, make_post, path):
+    _, headers = author
+    post_id = make_post(headers)
+    _, voter_headers = make_user()
+
+    etag = client.get(path.format(id=post_id), headers=headers).headers["ETag"]
+    vote(client, voter_headers, post_id)
+
+    # the old ETag doesn't match any more, the new body has the vote
+    after_vote = client.get(path.format(id=post_id), headers={**headers, "If-None-Match": etag})
+    assert after_vote.status_code == 200
+    assert after_vote.json()["votes"] == 1
+    assert after_vote.headers["ETag"] != etag
+
+    vote(client, voter_headers, post_id, dir=0)
+    assert client.get(path.format(id=post_id), headers=headers).json()["votes"] == 0
+
+
+def test_missing_post(client, author):
+    _, headers = author
+    assert client.get("/posts/0", headers=headers).status_code == 404
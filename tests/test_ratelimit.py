@@ -0,0 +1,126 @@
+# Token bucket rate limiting: bucket math, the 429 with Retry-After, swapping
+# the backend (a stand-in for the redis client) and RATE_LIMITS overrides
+import asyncio
+
+import pytest
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from app import ratelimit
+from app.config import DEFAULT_RATE_LIMITS, Settings, settings
+from app.ratelimit import InMemoryBackend, RateLimit, RedisBackend
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock.monotonic)
+    return clock
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    # rate limiting on, a fresh in-memory backend and only the limits of the test
+    monkeypatch.setattr(settings, "rate_limit_enabled", True)
+    limits = {}
+    monkeypatch.setattr(ratelimit, "limits", limits)
+    ratelimit.set_backend(InMemoryBackend())
+    yield limits
+    ratelimit.set_backend(None)
+
+
+def test_rate_limit_spec():
+    limit = RateLimit("20/60")
+    assert limit.capacity == 20
+    assert limit.refill_rate == pytest.approx(1 / 3)
+
+
+def test_token_refill(clock):
+    backend = InMemoryBackend()
+
+    def take(key="key"):
+        # bursts of 2, one token per second
+        return asyncio.run(backend.take(key, 2, 1))
+
+    assert take() == 0
+    assert take() == 0
+    assert take() == pytest.approx(1)
+    clock.now += 0.5
+    assert take() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert take() == 0
+    # never more than the capacity, however long it waited
+    clock.now += 3600
+    assert [take() for _ in range(3)] == [0, 0, pytest.approx(1)]
+    # buckets are per key
+    assert take("other") == 0
+
+
+def test_429_with_retry_after(limits, clock):
+    limits["test:ip"] = RateLimit("2/60")
+    app = FastAPI()
+
+    @app.get("/limited", dependencies=[Depends(ratelimit.limit_by_ip("test"))])
+    async def limited():
+        return {"ok": True}
+
+    with TestClient(app) as client:
+        assert client.get("/limited").status_code == 200
+        assert client.get("/limited").status_code == 200
+        response = client.get("/limited")
+        assert response.status_code == 429
+        # one token every 30 seconds
+        assert response.headers["Retry-After"] == "30"
+        clock.now += 30
+        assert client.get("/limited").status_code == 200
+
+
+def test_disabled(limits, monkeypatch):
+    limits["test:account"] = RateLimit("1/60")
+    monkeypatch.setattr(settings, "rate_limit_enabled", False)
+
+    for _ in range(2):
+        asyncio.run(ratelimit.hit("test:account", 1))
+
+
+class FakeRedis:
+    # stand-in for redis.asyncio.Redis: answers eval() from a list of retry_after values
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.calls = []
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        self.calls.append((numkeys, keys_and_args))
+        return self.answers.pop(0)
+
+
+def test_set_backend_with_a_fake_redis_client(limits):
+    limits["vote:account"] = RateLimit("120/60")
+    fake = FakeRedis([b"0", b"2.5"])
+    ratelimit.set_backend(RedisBackend(fake))
+
+    asyncio.run(ratelimit.hit("vote:account", 7))
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(ratelimit.hit("vote:account", 7))
+    assert error.value.status_code == 429
+    assert error.value.headers["Retry-After"] == "3"
+    # one key, then capacity, refill rate and cost for the script
+    assert fake.calls[0] == (1, ("ratelimit:vote:account:7", 120.0, 2.0, 1))
+
+
+def test_rate_limits_override_is_merged(monkeypatch):
+    monkeypatch.setenv("RATE_LIMITS", '{"login:ip": "50/60", "export:ip": "2/60"}')
+    rate_limits = Settings().rate_limits
+    assert rate_limits["login:ip"] == "50/60"
+    assert rate_limits["export:ip"] == "2/60"
+    # the other defaults are still there
+    for name in DEFAULT_RATE_LIMITS.keys() - {"login:ip"}:
+        assert rate_limits[name] == DEFAULT_RATE_LIMITS[name]
@@ -0,0 +1,118 @@
+# VoteBuffer durability, with a stand-in apply_votes and session (no database)
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app import vote_buffer as vote_buffer_module
+from app.vote_buffer import VoteBuffer
+
+
+class FakeSession:
+    def __init__(self, store):
+        self.store = store
+        self.staged = {}
+
+    async def commit(self):
+        self.store.update(self.staged)
+
+
+@pytest.fixture
+def written(monkeypatch):
+    # the "database": {(user_id, post_id): dir} of the committed votes
+    store = {}
+
+    @asynccontextmanager
+    async def db_session(read_only=False):
+        yield FakeSession(store)
+
+    monkeypatch.setattr(vote_buffer_module.database, "db_session", db_session)
+    return store
+
+
+def slow_apply_votes(started, release):
+    async def apply_votes(db, votes):
+        started.set()
+        await release.wait()
+        db.staged.update(votes)
+        return {key: "added" for key in votes}
+    return apply_votes
+
+
+def test_stop_waits_for_the_flush_in_progress(written):
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+        buffer = VoteBuffer(slow_apply_votes(started, release), flush_interval=0.01, max_size=1000)
+        buffer.start()
+        for user_id in range(50):
+            buffer.add(user_id, 1, 1)
+        await started.wait()
+        stopping = asyncio.create_task(buffer.stop())
+        await asyncio.sleep(0.05)
+        release.set()
+        await stopping
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert len(written) == 50
+    assert len(buffer) == 0
+
+
+def test_cancelled_flush_puts_the_votes_back(written):
+    async def scenario():
+        started, release = asyncio.Event(), asyncio.Event()
+        buffer = VoteBuffer(slow_apply_votes(started, release), flush_interval=60, max_size=1000)
+        buffer.add(1, 1, 1)
+        buffer.add(2, 1, 1)
+        flushing = asyncio.create_task(buffer.flush())
+        await started.wait()
+        # a newer vote of user 1 arrives while the batch is in flight
+        buffer.add(1, 1, -1)
+        flushing.cancel()
+        await asyncio.gather(flushing, return_exceptions=True)
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert written == {}
+    assert buffer._pending == {(1, 1): -1, (2, 1): 1}
+
+
+def test_failed_final_flush_is_logged(written, caplog):
+    async def failing_apply_votes(db, votes):
+        raise ConnectionError("database down")
+
+    async def scenario():
+        buffer = VoteBuffer(failing_apply_votes, flush_interval=60, max_size=1000)
+        buffer.start()
+        buffer.add(1, 1, 1)
+        await buffer.stop()
+
+    asyncio.run(scenario())
+    assert "1 votes lost" in caplog.text
+
+
+def test_flush_writes_max_size_votes_per_transaction(written):
+    transactions = []
+
+    async def apply_votes(db, votes):
+        transactions.append(len(votes))
+        if len(transactions) == 2:
+            raise ConnectionError("database down")
+        db.staged.update(votes)
+
+    async def scenario():
+        buffer = VoteBuffer(apply_votes, flush_interval=60, max_size=10)
+        for user_id in range(25):
+            buffer.add(user_id, 1, 1)
+        with pytest.raises(ConnectionError):
+            await buffer.flush()
+        # the failed transaction and the ones after it stay pending
+        assert len(written) == 10
+        assert len(buffer) == 15
+        await buffer.flush()
+        return buffer
+
+    buffer = asyncio.run(scenario())
+    assert transactions == [10, 10, 10, 5]
+    assert len(written) == 25
+    assert len(buffer) == 0
@@ -0,0 +1,80 @@
+# Set based vote writes: routers.vote.apply_votes (POST /vote/batch and the
+# vote buffer), a batch far above asyncpg's 32767 bind parameters included
+import uuid
+
+import pytest
+from sqlalchemy import delete, func, insert, select
+
+from app import database, models
+from app.routers.vote import apply_votes
+
+
+@pytest.fixture
+def posts(database):
+    # 100 users with 200 posts of the first one -> (user ids, post ids), removed afterwards
+    with database.begin() as connection:
+        prefix = uuid.uuid4().hex[:12]
+        user_ids = connection.execute(
+            insert(models.User).values([{"email": f"votes-{prefix}-{index}@example.com", "password": "x"} for index in range(100)])
+            .returning(models.User.id)
+        ).scalars().all()
+        post_ids = connection.execute(
+            insert(models.Post).values([{"title": "votes", "content": "votes", "user_id": user_ids[0]} for _ in range(200)])
+            .returning(models.Post.id)
+        ).scalars().all()
+    yield user_ids, post_ids
+    with database.begin() as connection:
+        connection.execute(delete(models.User).where(models.User.id.in_(user_ids)))
+
+
+def run_apply_votes(client, votes):
+    async def apply():
+        async with database.db_session() as db:
+            statuses = await apply_votes(db, votes)
+            await db.commit()
+            return statuses
+    return client.portal.call(apply)
+
+
+def vote_counts(database, post_ids):
+    with database.connect() as connection:
+        counts = connection.execute(select(models.Post.vote_count).where(models.Post.id.in_(post_ids))).scalars().all()
+        votes = connection.execute(select(func.count()).select_from(models.Vote).where(models.Vote.post_id.in_(post_ids))).scalar()
+    return sum(counts), votes
+
+
+def test_apply_votes_large_batch(client, database, posts):
+    user_ids, post_ids = posts
+    adds = {(user_id, post_id): 1 for user_id in user_ids for post_id in post_ids}
+    assert len(adds) == 20000
+
+    statuses = run_apply_votes(client, adds)
+    assert set(statuses.values()) == {"added"}
+    assert vote_counts(database, post_ids) == (20000, 20000)
+
+    # again: nothing changes
+    assert set(run_apply_votes(client, adds).values()) == {"already_voted"}
+
+    removes = {key: 0 for key in adds}
+    removes[(user_ids[0], 0)] = 0
+    statuses = run_apply_votes(client, removes)
+    assert statuses.pop((user_ids[0], 0)) == "post_not_found"
+    assert set(statuses.values()) == {"deleted"}
+    assert vote_counts(database, post_ids) == (0, 0)
+
+
+def test_vote_batch(client, make_user, make_post):
+    _, headers = make_user()
+    post_id = make_post(headers)
+
+    response = client.post("/vote/batch", json=[
+        {"post_id": post_id, "dir": 0},
+        {"post_id": post_id, "dir": 1},
+        {"post_id": 0, "dir": 1},
+    ], headers=headers)
+    assert response.status_code == 200, response.text
+    assert [item["status"] for item in response.json()] == ["superseded", "added", "post_not_found"]
+
+    response = client.post("/vote/batch", json=[{"post_id": post_id, "dir": 1}], headers=headers)
+    assert response.json()[0]["status"] == "already_voted"
+    assert client.get(f"/posts/{post_id}", headers=headers).json()["votes"] == 1
@@ -0,0 +1,26 @@
+# Startup warm-up: the lifespan's warm_up() has to finish, otherwise /readyz
+# stays 503 "warming_up" and a readiness gated load balancer never sends traffic
+import time
+
+from app import warmup
+
+
+def test_warm_up_reaches_ready(client, make_user, make_post):
+    deadline = time.monotonic() + 30
+    while True:
+        response = client.get("/readyz")
+        if response.status_code == 200 or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    assert response.status_code == 200, response.json()
+    assert response.json() == {"status": "ready"}
+    assert warmup.readiness.warmed_up
+
+    # again with a post for sure, so the response side (PostWithVote) runs too
+    _, headers = make_user()
+    make_post(headers)
+    client.portal.call(warmup.run_hot_statements)
+
+
+def test_healthz(client):
+    assert client.get("/healthz").json() == {"status": "ok"}